@@ -6,15 +6,29 @@ Created on Feb 21, 2012
 '''
 
 from amqplib import client_0_8 as amqp
+from collections import OrderedDict
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from struct import pack
+import multiprocessing
 import traceback
+import threading
+import select
 import json
-import re
+import time
+import os
 
 DEFAULT_USER = "guest"
 DEFAULT_PWD = "guest"
 DEFAULT_EXCHANGE_TYPE = "topic"
 SHUTDOWN = "shutdown"
-ALL_PATTERN = "*"
+ALL_PATTERN = "#"
+DEFAULT_BATCH_SIZE = 500
+WAIT_INTERVAL = 1.0
+MAX_CACHED_KEYS = 10000
+DEFAULT_POOL_SIZE = 8
+# Errors after which a connection is not reused
+CONNECTION_ERRORS = (amqp.AMQPException, IOError)
 
 class AMQ:
     ''' RabbitMQ Wrapper. 
@@ -24,6 +38,8 @@ class AMQ:
      
     Can act either as a consumer or a publisher, depending 
     on whether a message handler is provided at initialization time.
+    A consumer can also route messages to several handlers, by topic
+    pattern (see bind).
     '''
     
     verbose = True
@@ -50,6 +66,12 @@ class AMQ:
         self.shutdown_signal = SHUTDOWN
         self.publish_properties = { "content_type": "text/plain", "delivery_mode": 1 }
         self.queue_exists = False
+        self.tx_channel = None
+        self.workers = None
+        self.ack_batched = False
+        self.requeue = True
+        self.bindings = list()
+        self.matcher = TopicMatcher()
         
         self.conn_parameters = {"host": self.host,
                                 "userid": self.user,
@@ -67,25 +89,109 @@ class AMQ:
         if AMQ.verbose is True:
             print msg
     
-    def connect(self):
-        ''' Establish connection to the RabbitMQ server '''
+    def connect(self, declare_exchange=True):
+        ''' Establish connection to the RabbitMQ server 
+        declare_exchange:   Whether to declare the exchange (False if known to exist)
+        '''
         self.connection = amqp.Connection(self.host, self.user, self.pwd)
         self.channel = self.connection.channel()
-        self.channel.exchange_declare(self.exchange, DEFAULT_EXCHANGE_TYPE, durable=True)
+        if declare_exchange:
+            self.channel.exchange_declare(self.exchange, DEFAULT_EXCHANGE_TYPE, durable=True)
         self.on = True
         self._verbose("Connected to RabbitMQ @ %s:%d as \"%s\"" % (self.host, self.port, self.user))
 
+    def _make_message(self, message):
+        ''' Build an AMQP message from a string or JSON-compatible object '''
+        msg_data = json.dumps(message, False, False) if type(message) not in [str, unicode] else message
+        return amqp.Message(msg_data, **self.publish_properties)
+    
     def publish(self, message, routing_key):
         ''' Publish a given message 
         message:        Message content (string or JSON-compatiable object)
         routing_key:    Associated publication key
         '''
         
-        msg_data = json.dumps(message, False, False) if type(message) not in [str, unicode] else message
-        msg = amqp.Message(msg_data, **self.publish_properties)
-        
+        msg = self._make_message(message)
         self.channel.basic_publish(msg, self.exchange, routing_key)
     
+    def publish_many(self, messages, routing_key=None, confirm=False):
+        ''' Publish several messages back to back, written to the socket at once
+        messages:       List of messages, or of (message, routing key) pairs if no routing_key
+        routing_key:    Publication key shared by all messages
+        confirm:        Whether to wait until the broker has accepted all messages.
+                        They are published in one transaction, so either all or none 
+                        are delivered, and an exception is raised in the latter case.
+        Return the number of messages published
+        '''
+        
+        if routing_key is not None:
+            messages = [(m, routing_key) for m in messages]
+        if not messages:
+            return 0
+        channel = self._get_tx_channel() if confirm else self.channel
+        try:
+            with self._buffer_frames():
+                for (message, key) in messages:
+                    channel.basic_publish(self._make_message(message), self.exchange, key)
+            if confirm:
+                channel.tx_commit()
+        except Exception:
+            if confirm:
+                self._rollback()
+            raise
+        return len(messages)
+    
+    @contextmanager
+    def _buffer_frames(self):
+        ''' Collect the frames sent within the block, to write them to the socket in one call 
+        (amqplib writes each frame on its own). Nothing is written if the block raises.
+        '''
+        writer = self.connection.method_writer
+        transport = writer.dest
+        frames = FrameBuffer()
+        writer.dest = frames
+        try:
+            yield
+        finally:
+            writer.dest = transport
+        transport._write("".join(frames.frames))
+    
+    def batch(self, size=DEFAULT_BATCH_SIZE, confirm=False):
+        ''' Return a batch buffering messages, to be used as a context manager:
+        
+            with amq.batch(confirm=True) as batch:
+                batch.publish(message, routing_key)
+        
+        Messages are flushed every size messages and when leaving the block
+        (unless it raised). See publish_many for confirm.
+        '''
+        return AMQBatch(self, size, confirm)
+    
+    def _get_tx_channel(self):
+        ''' Return the channel used for confirmed publishing, in transaction mode '''
+        if self.tx_channel is None:
+            channel = self.connection.channel()
+            channel.tx_select()
+            self.tx_channel = channel
+        return self.tx_channel
+    
+    def _rollback(self):
+        ''' Discard uncommitted messages, dropping the channel if it is broken '''
+        try:
+            self.tx_channel.tx_rollback()
+        except Exception:
+            self.tx_channel = None
+    
+    def bind(self, routing_key, handler):
+        ''' Route messages matching a topic pattern to a handler, when monitoring.
+        A message matching several bindings is passed to each of their handlers
+        (in the order they were bound), and only acknowledged if they all succeed.
+        routing_key:    Topic pattern (words separated by ".", "*" matches one word, "#" zero or more)
+        handler:        Method to handle matching messages, same signature as message_handler
+        '''
+        self.bindings.append((routing_key, handler))
+        self.matcher.add(routing_key, handler)
+    
     def _on_message_received(self, msg):
         ''' Internally called whenever a new message is received '''
         if not msg:
@@ -93,42 +199,116 @@ class AMQ:
         if msg.body == self.shutdown_signal:
             # Shutdown
             self._verbose("Received shutdown signal")
+            if self.ack_batched:
+                # Acknowledged with the messages before it
+                self.in_flight[msg.delivery_tag] = True
+            else:
+                self.channel.basic_ack(msg.delivery_tag)
+            if self.workers:
+                # Stop receiving, finish handling what was received
+                self.channel.basic_cancel(msg.consumer_tag)
+                self.draining = True
+            else:
+                self.close(msg.consumer_tag)
+        elif not self.matcher.match(msg.routing_key):
+            # Wrong delivery, hand it back for other consumers of the queue
+            # (it would hold a prefetch slot otherwise)
+            self.channel.basic_reject(msg.delivery_tag, True)
+        elif self.workers:
+            self.in_flight[msg.delivery_tag] = None
+            self.tasks.put(msg)
+        elif self._handle(msg):
             self.channel.basic_ack(msg.delivery_tag)
-            self.close(msg.consumer_tag)
         else:
-            try:
-                if not self.routing_key_pattern.match(msg.routing_key):
-                    # Wrong delivery, skip without ack'ing
-                    return
-                params = { 'key': msg.routing_key, 'tag': msg.delivery_tag }
-                self.message_handler(msg.body, **params)
-                self.channel.basic_ack(msg.delivery_tag)
-            except Exception, e:
-                self._verbose("Error while handling message: %s" % e)
-                traceback.print_stack()
+            self.channel.basic_reject(msg.delivery_tag, self.requeue)
+    
+    def _dispatch(self, body, key=None, tag=None):
+        ''' Pass a message to the handlers bound to its routing key '''
+        for handler in self.matcher.match(key):
+            handler(body, key=key, tag=tag)
     
-    def monitor(self, routing_key=None):
+    def _handle(self, msg):
+        ''' Pass a message to its handlers, return whether they all succeeded '''
+        try:
+            params = { 'key': msg.routing_key, 'tag': msg.delivery_tag }
+            self._dispatch(msg.body, **params)
+            return True
+        except Exception, e:
+            self._verbose("Error while handling message: %s" % e)
+            traceback.print_stack()
+            return False
+    
+    def monitor(self, routing_key=None, workers=1, prefetch=None, ordered_acks=False, processes=False,
+                ack_every=1, ack_interval=None, requeue=True):
         ''' Start monitor for incoming message from the previously specified queue.
         This method blocks until this instance is terminated or a shutdown signal is received.
-        routing_key:    Key to listen for
-        '''
+        routing_key:    Topic pattern to listen for, routed to message_handler
+                        (default: all messages, unless handlers were bound with bind)
+        workers:        Number of threads handling messages concurrently 
+                        (1 = handle them one at a time on the channel thread)
+        prefetch:       Maximum number of unacknowledged messages delivered at once
+                        (default: 2 per worker with several workers, twice ack_every with 
+                        batched acks, unlimited otherwise)
+        ordered_acks:   Whether to acknowledge messages in delivery order
+                        rather than as soon as they are handled
+        processes:      Whether to handle messages in worker processes rather than threads,
+                        for CPU-bound handlers (this process then only dispatches and acks)
+        ack_every:      Number of handled messages acknowledged at once, with a single
+                        multiple ack (1 = acknowledge each message on its own)
+        ack_interval:   Maximum time in seconds a handled message waits for its 
+                        acknowledgement (batched acks only, None = no limit)
+        requeue:        Whether messages whose handler fails are requeued
         
-        if not self.message_handler:
-            raise Exception("No message handler provided")
+        With several workers, the shutdown signal stops deliveries, then waits for
+        the messages already received to be handled before closing the connection.
         
-        if not routing_key:
-            routing_key = ALL_PATTERN
+        A message whose handler fails is rejected right away, so that it does not hold 
+        a prefetch slot: it is redelivered at once (possibly to another consumer) if 
+        requeue, otherwise dropped or dead-lettered. A message not matching any binding 
+        is always requeued, for the other consumers of the queue, and so is a message whose 
+        worker process dies (the process being restarted).
+        
+        With batched acks (ack_every > 1 or ack_interval), messages are acknowledged in
+        delivery order, up to the first one still being handled. Handled messages not 
+        acknowledged yet when the connection is lost are redelivered, so handlers should 
+        be idempotent.
+        '''
+        
+        if routing_key or not self.bindings:
+            if not self.message_handler:
+                raise Exception("No message handler provided")
+            self.bind(routing_key or ALL_PATTERN, self.message_handler)
         
         if not self.queue_exists:
             self.channel.queue_declare(self.queue_name, durable=True, auto_delete=False)
-            self.channel.queue_bind(self.queue_name, self.exchange, routing_key)
+            for key in set(key for (key, handler) in self.bindings):
+                self.channel.queue_bind(self.queue_name, self.exchange, key)
             self._verbose("Declared queue %s" % self.queue_name)
             
+        routing_key = ", ".join(key for (key, handler) in self.bindings)
         self.routing_key = routing_key
-        self.routing_key_pattern = re.compile(self.routing_key)
+        if ack_every > 1 and not prefetch:
+            prefetch = max(2 * workers, 2 * ack_every)
+        # Deliveries would stop before a batch is complete otherwise
+        self.ack_every = min(ack_every, prefetch) if prefetch else ack_every
+        self.ack_interval = ack_interval
+        self.ack_batched = (ack_every > 1 or ack_interval is not None)
+        self.requeue = requeue
+        self.ack_tag = None
+        self.n_unacked = 0
+        self.last_ack = time.time()
+        # Batched acks are sent from the consumption loop with workers
+        concurrent = (workers > 1 or processes or self.ack_batched)
+        if prefetch or concurrent:
+            self.channel.basic_qos(0, prefetch or 2 * workers, False)
+        if concurrent:
+            self._start_workers(workers, processes)
         self.channel.basic_consume(self.queue_name, callback=self._on_message_received)
         self._verbose("Started consuming %s from %s" % (routing_key, self.queue_name))
         
+        if concurrent:
+            return self._consume(ordered_acks)
+        
         # Consumption loop
         while True:
             try:
@@ -140,12 +320,402 @@ class AMQ:
                 else:
                     break
     
+    def _start_workers(self, n, processes=False):
+        ''' Start the threads handling messages, each driving a process if required '''
+        self.tasks = Queue()
+        self.done = Queue()
+        self.in_flight = OrderedDict()
+        self.draining = False
+        self.wakeup = os.pipe()
+        # Fork before any thread is started
+        procs = [AMQWorkerProcess(self._dispatch, self._verbose) if processes else None for i in range(n)]
+        self.workers = [threading.Thread(target=self._work, args=(procs[i],), name="amq-worker-%s" % i) 
+                        for i in range(n)]
+        for t in self.workers:
+            t.daemon = True
+            t.start()
+    
+    def _work(self, proc=None):
+        ''' Worker loop, hands results back to the channel thread 
+        proc:   Worker process to handle messages in (None = This thread)
+        '''
+        try:
+            while True:
+                msg = self.tasks.get()
+                if msg is None:
+                    return
+                ok = proc.handle(msg) if proc else self._handle(msg)
+                self.done.put((msg.delivery_tag, ok))
+                os.write(self.wakeup[1], "x")
+        finally:
+            if proc:
+                proc.stop()
+    
+    def _consume(self, ordered_acks):
+        ''' Consumption loop with workers, the channel is only used from this thread '''
+        try:
+            while self.on and not (self.draining and not self.in_flight):
+                try:
+                    self._wait(min(WAIT_INTERVAL, self.ack_interval or WAIT_INTERVAL))
+                    self._send_acks(ordered_acks)
+                except Exception, e:
+                    if self.on:
+                        self._verbose("Error while waiting for messages: %s" % e)
+                        traceback.print_stack()
+                    else:
+                        break
+        finally:
+            for _ in self.workers:
+                self.tasks.put(None)
+            self.workers = None
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+        if self.on:
+            self._flush_acks()
+            self.close()
+    
+    def _wait(self, timeout):
+        ''' Process incoming methods, or wait up to timeout for any, 
+        returning early when a worker is done with a message 
+        '''
+        conn = self.connection
+        transport = conn.transport
+        buffered = (self.channel.method_queue or not conn.method_reader.queue.empty() 
+                    or getattr(transport, "_read_buffer", None)
+                    or (hasattr(transport, "sslobj") and transport.sslobj.pending()))
+        if not buffered:
+            ready = select.select([transport.sock, self.wakeup[0]], [], [], timeout)[0]
+            if self.wakeup[0] in ready:
+                os.read(self.wakeup[0], 4096)
+            if transport.sock not in ready:
+                return
+        self.channel.wait()
+    
+    def _send_acks(self, ordered):
+        ''' Acknowledge messages the workers are done with '''
+        done = list()
+        while True:
+            try:
+                (tag, ok) = self.done.get_nowait()
+            except Empty:
+                break
+            self.in_flight[tag] = bool(ok)
+            done.append(tag)
+            if not ok:
+                # Requeued anyway if the worker process died (None)
+                self.channel.basic_reject(tag, self.requeue or ok is None)
+        # Failures are rejected already
+        if self.ack_batched:
+            # Up to the first message still being handled
+            while self.in_flight:
+                tag = next(iter(self.in_flight))
+                if self.in_flight[tag] is None:
+                    break
+                if self.in_flight.pop(tag):
+                    self.ack_tag = tag
+                    self.n_unacked += 1
+            if self.n_unacked >= self.ack_every or (self.ack_interval is not None
+                                                    and time.time() - self.last_ack >= self.ack_interval):
+                self._flush_acks()
+        elif ordered:
+            # Up to the first message still being handled
+            while self.in_flight:
+                tag = next(iter(self.in_flight))
+                if self.in_flight[tag] is None:
+                    break
+                if self.in_flight.pop(tag):
+                    self.channel.basic_ack(tag)
+        else:
+            for tag in done:
+                if self.in_flight.pop(tag):
+                    self.channel.basic_ack(tag)
+    
+    def _flush_acks(self):
+        ''' Acknowledge all messages handled so far at once (batched acks) '''
+        if self.n_unacked:
+            self.channel.basic_ack(self.ack_tag, multiple=True)
+            self.n_unacked = 0
+        self.last_ack = time.time()
+    
     def close(self, consumer_tag=None):
         ''' Terminate the connection to the server and any active listening loop '''
         self.on = False
         if consumer_tag:
             self.channel.basic_cancel(consumer_tag)
+        if self.tx_channel is not None:
+            self.tx_channel.close()
+            self.tx_channel = None
         self.channel.close()
         self.connection.close()
         self._verbose("Closed connection to RabbitMQ @ %s" % self.host)
 
+
+
+class TopicMatcher:
+    ''' Matcher of routing keys against AMQP topic patterns, compiled into a trie 
+    so that the cost of a match depends on the key rather than on the number of patterns.
+    Results are cached per routing key.
+    '''
+    
+    def __init__(self):
+        self.root = TopicNode()
+        self.count = 0
+        self.cache = dict()
+    
+    def add(self, pattern, value):
+        ''' Add a pattern, associated with a given value '''
+        node = self.root
+        for word in pattern.split("."):
+            node = node.children.setdefault(word, TopicNode())
+        node.values.append((self.count, value))
+        self.count += 1
+        self.cache = dict()
+    
+    def match(self, key):
+        ''' Return the values of the patterns matching a routing key, in the order they were added '''
+        res = self.cache.get(key)
+        if res is None:
+            found = dict()
+            self._match(self.root, (key or "").split("."), 0, found, set())
+            res = [found[i] for i in sorted(found)]
+            if len(self.cache) >= MAX_CACHED_KEYS:
+                self.cache = dict()
+            self.cache[key] = res
+        return res
+    
+    def _match(self, node, words, i, found, seen):
+        ''' Collect the values of the patterns under a node that match words[i:] '''
+        if (id(node), i) in seen:
+            return
+        seen.add((id(node), i))
+        if i == len(words):
+            found.update(node.values)
+        else:
+            for word in (words[i], "*"):
+                child = node.children.get(word)
+                if child:
+                    self._match(child, words, i + 1, found, seen)
+        hash_node = node.children.get("#")
+        if hash_node:
+            # Matches zero or more words
+            for j in range(i, len(words) + 1):
+                self._match(hash_node, words, j, found, seen)
+
+
+class TopicNode:
+    ''' Node of a TopicMatcher, one per pattern word '''
+    
+    def __init__(self):
+        self.children = dict()
+        self.values = list()
+
+
+class AMQBatch:
+    ''' Buffer of messages published together (see AMQ.batch) '''
+    
+    def __init__(self, amq, size=DEFAULT_BATCH_SIZE, confirm=False):
+        self.amq = amq
+        self.size = size
+        self.confirm = confirm
+        self.messages = list()
+        self.published = 0
+    
+    def publish(self, message, routing_key):
+        ''' Buffer a message, flushing the batch if full '''
+        self.messages.append((message, routing_key))
+        if len(self.messages) >= self.size:
+            self.flush()
+    
+    def flush(self):
+        ''' Publish all buffered messages, return how many were published '''
+        (messages, self.messages) = (self.messages, list())
+        n = self.amq.publish_many(messages, confirm=self.confirm)
+        self.published += n
+        return n
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.messages = list()
+
+
+class FrameBuffer:
+    ''' Stand-in for an amqplib transport, keeping frames instead of writing them '''
+    
+    def __init__(self):
+        self.frames = list()
+    
+    def write_frame(self, frame_type, channel, payload):
+        ''' Same framing as the transport '''
+        self.frames.append(pack(">BHI", frame_type, channel, len(payload)) + payload + "\xce")
+
+
+def _run_worker_process(conn, handler, verbose):
+    ''' Main loop of a worker process: handle messages sent by the supervisor 
+    and send back whether each succeeded 
+    '''
+    while True:
+        item = conn.recv()
+        if item is None:
+            return
+        (body, key, tag) = item
+        try:
+            handler(body, key=key, tag=tag)
+            conn.send(True)
+        except Exception, e:
+            verbose("Error while handling message: %s" % e)
+            traceback.print_exc()
+            conn.send(False)
+
+
+class AMQWorkerProcess:
+    ''' Process handling messages on behalf of a consumer, restarted if it dies '''
+    
+    STOP_TIMEOUT = 5
+    
+    def __init__(self, handler, verbose):
+        ''' Create and start a new worker process
+        handler:    Method handling messages, called in the process
+        verbose:    Method printing out status messages (see AMQ._verbose)
+        '''
+        self.handler = handler
+        self.verbose = verbose
+        self.start()
+    
+    def start(self):
+        ''' Start the process '''
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_run_worker_process, args=(child_conn, self.handler, self.verbose))
+        self.process.daemon = True
+        self.process.start()
+        # Only the child holds its end now, so its death shows as EOF
+        child_conn.close()
+    
+    def handle(self, msg):
+        ''' Have the process handle a message, return whether it succeeded,
+        or None if the process died handling it (it is restarted then)
+        '''
+        try:
+            self.conn.send((msg.body, msg.routing_key, msg.delivery_tag))
+            return self.conn.recv()
+        except (EOFError, IOError, OSError):
+            self.conn.close()
+            self.process.join(self.STOP_TIMEOUT)
+            self.verbose("Worker process %s died (exit code %s), restarting it" % (self.process.pid, self.process.exitcode))
+            self.start()
+            return None
+    
+    def stop(self):
+        ''' Stop the process once done with the current message '''
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(self.STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class AMQPool:
+    ''' Thread-safe pool of long-lived publisher connections, to be shared by request threads:
+    
+        pool = AMQPool(config, size=8)
+        pool.publish(message, routing_key)
+    
+    Connections are opened on first use, up to size, and the exchange is declared 
+    on the first one only. A connection that fails is dropped and reopened on next use.
+    '''
+    
+    def __init__(self, config, size=DEFAULT_POOL_SIZE, timeout=None):
+        ''' Create a new pool
+        config:     Config map (see AMQ)
+        size:       Maximum number of connections
+        timeout:    Maximum time in seconds to wait for a free connection (None = Infinity)
+        '''
+        self.config = config
+        self.timeout = timeout
+        self.declared = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.idle = Queue()
+        for i in range(size):
+            self.idle.put(AMQ(config))
+    
+    @contextmanager
+    def acquire(self):
+        ''' Borrow a connected publisher for the current thread, to be used as a context manager:
+        
+            with pool.acquire() as amq:
+                amq.publish(message, routing_key)
+        
+        Raise Queue.Empty if none is free within the timeout.
+        '''
+        if self.closed:
+            raise Exception("Pool is closed")
+        amq = self.idle.get(True, self.timeout)
+        try:
+            if not getattr(amq, "on", False):
+                self._connect(amq)
+            yield amq
+        except CONNECTION_ERRORS:
+            self._discard(amq)
+            amq = AMQ(self.config)
+            raise
+        finally:
+            if self.closed:
+                self._discard(amq)
+            else:
+                self.idle.put(amq)
+    
+    def publish(self, message, routing_key):
+        ''' See AMQ.publish '''
+        return self._call("publish", message, routing_key)
+    
+    def publish_many(self, messages, routing_key=None, confirm=False):
+        ''' See AMQ.publish_many '''
+        return self._call("publish_many", messages, routing_key, confirm)
+    
+    def close(self):
+        ''' Close idle connections, and the others once they are released '''
+        self.closed = True
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except Empty:
+                break
+    
+    def _call(self, method, *args):
+        ''' Call a publisher method, retrying once on a new connection if the one 
+        used is broken (e.g. after a broker restart). A message may then be published 
+        twice, if the connection broke after it was sent.
+        '''
+        for attempt in range(2):
+            try:
+                with self.acquire() as amq:
+                    return getattr(amq, method)(*args)
+            except CONNECTION_ERRORS:
+                if attempt or self.closed:
+                    raise
+    
+    def _connect(self, amq):
+        ''' Connect a publisher, declaring the exchange on the first connection only '''
+        if not self.declared:
+            with self.lock:
+                if not self.declared:
+                    amq.connect()
+                    self.declared = True
+                    return
+        amq.connect(False)
+    
+    def _discard(self, amq):
+        ''' Close a publisher, ignoring errors on broken connections '''
+        if getattr(amq, "on", False):
+            try:
+                amq.close()
+            except Exception:
+                pass
@@ -0,0 +1,173 @@
+'''
+Created on Oct 18, 2026
+
+Non-blocking front end to AMQ.
+
+Publishing calls run on a thread owning the publisher connection (amqplib
+channels are not thread-safe) and return futures right away, so an event
+loop never blocks on the broker. Consuming runs AMQ.monitor with one
+worker per message in flight, on a background thread, and hands messages
+over either to handlers returning futures, or as futures to fetch one at
+a time (or to iterate over, blocking):
+
+    amq = AsyncAMQ(config, "queue")
+    amq.connect().result()
+    amq.publish({'id': 1}, "item.created")
+    messages = amq.messages("item.*")
+    messages.fetch().add_done_callback(...)
+    for msg in messages:
+        ...
+        msg.ack()
+
+Routing and the shutdown signal work as with AMQ.
+
+@requires: amqplib (pip install amqplib), futures (pip install futures)
+'''
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from pyutils.lib.amq import AMQ
+from collections import deque
+import threading
+
+DEFAULT_CONCURRENCY = 16
+
+class AsyncAMQ:
+    ''' Asynchronous mirror of the AMQ API.
+    Publishing methods return a concurrent.futures.Future.
+    '''
+
+    def __init__(self, config, queue=None, concurrency=DEFAULT_CONCURRENCY):
+        ''' Create a new wrapper instance
+        config:         Config map (see AMQ)
+        queue:          Queue to consume from
+        concurrency:    Maximum number of messages being handled at once
+        '''
+        self.config = config
+        self.queue_name = queue
+        self.concurrency = concurrency
+        self.publisher = AMQ(config)
+        self.executor = ThreadPoolExecutor(1)
+
+    def connect(self):
+        ''' See AMQ.connect (publisher connection) '''
+        return self.executor.submit(self.publisher.connect)
+
+    def publish(self, message, routing_key):
+        ''' See AMQ.publish '''
+        return self.executor.submit(self.publisher.publish, message, routing_key)
+
+    def publish_many(self, messages, routing_key=None, confirm=False):
+        ''' See AMQ.publish_many '''
+        return self.executor.submit(self.publisher.publish_many, messages, routing_key, confirm)
+
+    def close(self):
+        ''' Close the publisher connection once pending publications are done '''
+        f = self.executor.submit(self.publisher.close)
+        self.executor.shutdown(False)
+        return f
+
+    def consume(self, handler, routing_key=None, ordered_acks=False, requeue=True):
+        ''' Start consuming messages in the background
+        handler:        Method called with (body, key=, tag=) for each message,
+                        from a worker thread. It may return a Future, in which case
+                        the message is acknowledged once it resolves without error,
+                        rejected otherwise.
+        routing_key:    Key to listen for
+        ordered_acks:   See AMQ.monitor
+        requeue:        See AMQ.monitor
+        Return a Future resolved when consumption stops (i.e. on shutdown signal)
+        '''
+        def run(body, **params):
+            res = handler(body, **params)
+            if isinstance(res, Future):
+                res.result()
+        consumer = AMQ(self.config, self.queue_name, run)
+        def monitor():
+            consumer.connect()
+            consumer.monitor(routing_key, workers=self.concurrency, prefetch=self.concurrency,
+                             ordered_acks=ordered_acks, requeue=requeue)
+        executor = ThreadPoolExecutor(1)
+        f = executor.submit(monitor)
+        executor.shutdown(False)
+        return f
+
+    def messages(self, routing_key=None, ordered_acks=False, requeue=True):
+        ''' Start consuming messages in the background, return an AMQMessages to fetch them from.
+        Each message must be acknowledged or rejected, and no more than
+        concurrency messages are received until then.
+        See consume for the parameters.
+        '''
+        return AMQMessages(self, routing_key, ordered_acks, requeue)
+
+
+class AMQMessages:
+    ''' Stream of messages received through AsyncAMQ.messages '''
+    
+    def __init__(self, amq, routing_key=None, ordered_acks=False, requeue=True):
+        self.lock = threading.Lock()
+        self.deliveries = deque()
+        self.waiters = deque()
+        self.stopped = False
+        self.consumer = amq.consume(self._on_message, routing_key, ordered_acks, requeue)
+        self.consumer.add_done_callback(self._on_stop)
+    
+    def _on_message(self, body, **params):
+        ''' Hand a message over to the oldest pending fetch, or keep it for the next one '''
+        delivery = AMQDelivery(body, params['key'], params['tag'])
+        with self.lock:
+            waiter = self.waiters.popleft() if self.waiters else None
+            if waiter is None:
+                self.deliveries.append(delivery)
+        if waiter is not None:
+            waiter.set_result(delivery)
+        return delivery.future
+    
+    def _on_stop(self, f):
+        ''' Resolve pending fetches once consumption stopped '''
+        with self.lock:
+            self.stopped = True
+            (waiters, self.waiters) = (self.waiters, deque())
+        for waiter in waiters:
+            waiter.set_result(None)
+    
+    def fetch(self):
+        ''' Return a Future resolved with the next message (AMQDelivery), 
+        or None once consumption stopped (i.e. on shutdown signal, once all 
+        received messages were acknowledged or rejected)
+        '''
+        f = Future()
+        with self.lock:
+            if self.deliveries:
+                f.set_result(self.deliveries.popleft())
+            elif self.stopped:
+                f.set_result(None)
+            else:
+                self.waiters.append(f)
+        return f
+    
+    def __iter__(self):
+        ''' Iterate over messages, blocking until each is received '''
+        while True:
+            delivery = self.fetch().result()
+            if delivery is None:
+                break
+            yield delivery
+        self.consumer.result()
+
+
+class AMQDelivery:
+    ''' Message received through AsyncAMQ.messages '''
+
+    def __init__(self, body, key, tag):
+        self.body = body
+        self.key = key
+        self.tag = tag
+        self.future = Future()
+
+    def ack(self):
+        ''' Acknowledge the message '''
+        self.future.set_result(True)
+
+    def reject(self):
+        ''' Reject the message, requeued unless consuming with requeue=False '''
+        self.future.set_exception(Exception("Message %s rejected" % self.tag))
@@ -0,0 +1,107 @@
+'''
+Created on Oct 18, 2026
+
+Non-blocking front end to Cache.
+
+Calls run on a thread pool sharing Cache's connection pool and
+return futures right away, so an event loop (e.g. Tornado, which can
+yield these futures) never blocks on Redis and many lookups can be
+in flight at once. Values go through the same type dispatch and codec
+as Cache.
+
+@requires: futures (pip install futures)
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from pyutils.lib.cache import Cache
+
+DEFAULT_WORKERS = 32
+
+class AsyncCache:
+    ''' Asynchronous mirror of the Cache API.
+    Every method returns a concurrent.futures.Future.
+    '''
+
+    executor = ThreadPoolExecutor(DEFAULT_WORKERS)
+
+    @classmethod
+    def init(cls, workers=DEFAULT_WORKERS):
+        ''' Set the number of concurrent calls.
+        Should not exceed the size of Cache's connection pool.
+        '''
+        old = cls.executor
+        cls.executor = ThreadPoolExecutor(workers)
+        old.shutdown(False)
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        ''' Stop accepting calls, optionally wait for pending ones '''
+        cls.executor.shutdown(wait)
+
+    @classmethod
+    def gather(cls, *futures, **kw):
+        ''' Wait for several calls, return their results in order
+        timeout:    Maximum time to wait in seconds (None = Infinity)
+        '''
+        timeout = kw.get('timeout', None)
+        return [f.result(timeout) for f in futures]
+
+    @classmethod
+    def put(cls, key, obj, ttl=None, **options):
+        ''' See Cache.put '''
+        return cls.executor.submit(Cache.put, key, obj, ttl, **options)
+
+    @classmethod
+    def put_many(cls, mapping, ttl=None, **options):
+        ''' See Cache.put_many '''
+        return cls.executor.submit(Cache.put_many, mapping, ttl, **options)
+
+    @classmethod
+    def get(cls, key, **options):
+        ''' See Cache.get '''
+        return cls.executor.submit(Cache.get, key, **options)
+
+    @classmethod
+    def get_many(cls, keys, **options):
+        ''' See Cache.get_many '''
+        return cls.executor.submit(Cache.get_many, keys, **options)
+
+    @classmethod
+    def has(cls, key):
+        ''' See Cache.has '''
+        return cls.executor.submit(Cache.has, key)
+
+    @classmethod
+    def remove(cls, key_pattern, get_val=True, exact=False):
+        ''' See Cache.remove '''
+        return cls.executor.submit(Cache.remove, key_pattern, get_val, exact=exact)
+
+    @classmethod
+    def size(cls, key=None):
+        ''' See Cache.size '''
+        return cls.executor.submit(Cache.size, key)
+
+    @classmethod
+    def union(cls, *keys, **kw):
+        ''' See Cache.union '''
+        return cls.executor.submit(Cache.union, *keys, **kw)
+
+    @classmethod
+    def inter(cls, *keys, **kw):
+        ''' See Cache.inter '''
+        return cls.executor.submit(Cache.inter, *keys, **kw)
+
+    @classmethod
+    def union_card(cls, *keys):
+        ''' See Cache.union_card '''
+        return cls.executor.submit(Cache.union_card, *keys)
+
+    @classmethod
+    def inter_card(cls, *keys):
+        ''' See Cache.inter_card '''
+        return cls.executor.submit(Cache.inter_card, *keys)
+
+    @classmethod
+    def keys(cls, pattern):
+        ''' See Cache.keys '''
+        return cls.executor.submit(Cache.keys, pattern)
@@ -0,0 +1,259 @@
+'''
+Created on Oct 18, 2026
+
+Bloom filters used by Cache to answer lookups of absent keys
+without a round trip to Redis.
+
+A KeyFilter tracks the keys of one namespace. It is checked in process and
+updated before every put, so a key it does not contain cannot exist. Keys
+being written when a sync or rebuild starts, or written while it runs, are
+added to its result, as their bits or values may be missed by it. Keys
+that are removed or expire stay in the filter (they only cost a normal
+lookup) until it is rebuilt by scanning the namespace.
+
+In shared mode, the filter is also kept in Redis as two bitmaps, so that
+puts from every process are seen: each put sets its bits in both bitmaps,
+a rebuild refills the inactive one then makes it active, and each process
+reloads the active bitmap periodically. Puts from other processes may
+then go unseen for up to the sync interval.
+
+In local mode, puts from other processes go unseen until the next
+periodic rebuild.
+
+@requires: redis (pip install redis)
+'''
+
+from hashlib import md5
+from math import ceil, log
+import threading
+import struct
+import time
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_SYNC_INTERVAL = 10
+DEFAULT_REBUILD_INTERVAL = 3600
+SCAN_COUNT = 1000
+REDIS_PREFIX = "bloom:"
+
+class BloomFilter:
+    ''' Fixed size Bloom filter, with the same bit layout as Redis bitmaps '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        ''' Create an empty filter
+        capacity:   Expected number of items
+        error_rate: False positive rate when holding capacity items
+        '''
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.size) / capacity * log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        ''' Return the bit positions of a key '''
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        (h1, h2) = struct.unpack("<QQ", md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        ''' Add a key '''
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+
+    def __contains__(self, key):
+        ''' Return whether a key may have been added (False means it has not) '''
+        for pos in self.positions(key):
+            if not self.bits[pos >> 3] & (0x80 >> (pos & 7)):
+                return False
+        return True
+
+    def load(self, data):
+        ''' Replace the bits with the content of a Redis bitmap '''
+        bits = bytearray(data or "")[:len(self.bits)]
+        self.bits = bits + bytearray(len(self.bits) - len(bits))
+
+    def copy(self):
+        ''' Return an empty filter with the same parameters '''
+        return BloomFilter(self.capacity, self.error_rate)
+
+
+class KeyFilter:
+    ''' Filter of the keys with a given prefix, see module description '''
+
+    def __init__(self, redis, prefix, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, shared=True,
+                 sync_interval=DEFAULT_SYNC_INTERVAL, rebuild_interval=DEFAULT_REBUILD_INTERVAL):
+        ''' Create a filter and start building it in the background
+        redis:              Redis client
+        prefix:             Prefix of the tracked keys
+        capacity:           Expected number of keys
+        error_rate:         False positive rate when holding capacity keys
+        shared:             Whether to share the filter with other processes through Redis
+        sync_interval:      Time in seconds between reloads of the shared filter
+        rebuild_interval:   Time in seconds between rebuilds
+        '''
+        self.redis = redis
+        self.prefix = prefix
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.pending = None
+        self.recent = None
+        self.writing = list()
+        self.ready = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Hash tag keeps the bitmaps together when sharded
+        base = "%s{%s}" % (REDIS_PREFIX, prefix)
+        self.bitmap_keys = (base + ":0", base + ":1")
+        self.active_key = base + ":active"
+        self.rebuild_lock_key = base + ":lock"
+        self.worker = threading.Thread(target=self._run, name="cache-key-filter")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def might_contain(self, key):
+        ''' Return False if a key is known not to exist '''
+        return not self.ready or key in self.bloom
+
+    def add(self, keys):
+        ''' Track new keys, must be called before writing them, 
+        and followed by a call to added once they are written (or failed to) 
+        '''
+        with self.lock:
+            for key in keys:
+                self.bloom.add(key)
+                if self.pending is not None:
+                    self.pending.add(key)
+                if self.recent is not None:
+                    self.recent.append(key)
+            self.writing.append(keys)
+        if self.shared:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in keys:
+                    for pos in self.bloom.positions(key):
+                        for bitmap_key in self.bitmap_keys:
+                            pipe.setbit(bitmap_key, pos, 1)
+                pipe.execute()
+            except Exception:
+                self.added(keys)
+                raise
+
+    def added(self, keys):
+        ''' Record that keys passed to add were written '''
+        with self.lock:
+            self.writing.remove(keys)
+
+    def clear(self):
+        ''' Forget all keys, e.g. after a flush '''
+        with self.lock:
+            self.bloom = self.bloom.copy()
+            if self.pending is not None:
+                self.pending = self.bloom.copy()
+
+    def close(self):
+        ''' Stop syncing and rebuilding '''
+        self.stopped.set()
+        if self.worker is not threading.current_thread():
+            self.worker.join()
+
+    def _start_recording(self):
+        ''' Start recording the keys written from now on, 
+        as well as the ones being written (lock must be held)
+        '''
+        self.recent = [key for keys in self.writing for key in keys]
+
+    def sync(self):
+        ''' Reload the shared filter from Redis '''
+        with self.lock:
+            self._start_recording()
+        try:
+            active = int(self.redis.get(self.active_key) or 0)
+            bloom = self.bloom.copy()
+            bloom.load(self.redis.get(self.bitmap_keys[active]))
+            with self.lock:
+                # Keep keys added by this process meanwhile, their bits may have been missed
+                for key in self.recent:
+                    bloom.add(key)
+                self.bloom = bloom
+                self.ready = True
+        finally:
+            with self.lock:
+                self.recent = None
+
+    def rebuild(self):
+        ''' Rebuild the filter from the keys currently in Redis '''
+        r = self.redis
+        if self.shared:
+            if not r.set(self.rebuild_lock_key, 1, ex=max(self.rebuild_interval, 60), nx=True):
+                # Another process is rebuilding it
+                return False
+            active = int(r.get(self.active_key) or 0)
+            standby = self.bitmap_keys[1 - active]
+            r.delete(standby)
+        with self.lock:
+            self.pending = self.bloom.copy()
+            # Keys being written may be missed by the scan
+            self._start_recording()
+            for key in self.recent:
+                self.pending.add(key)
+        try:
+            batch = list()
+            for key in r.scan_iter(match=self.prefix + "*", count=SCAN_COUNT):
+                batch.append(key)
+                if len(batch) >= SCAN_COUNT:
+                    self._fill(batch, standby if self.shared else None)
+                    batch = list()
+            self._fill(batch, standby if self.shared else None)
+            if self.shared:
+                # Keys written meanwhile may have had their bits set before the standby was reset
+                with self.lock:
+                    recent = list(self.recent)
+                self._fill(recent, standby)
+                r.set(self.active_key, 1 - active)
+            with self.lock:
+                (self.bloom, self.pending) = (self.pending, None)
+                self.ready = True
+        finally:
+            with self.lock:
+                (self.pending, self.recent) = (None, None)
+            if self.shared:
+                r.delete(self.rebuild_lock_key)
+        return True
+
+    def _fill(self, keys, bitmap_key=None):
+        ''' Add scanned keys to the filter being rebuilt '''
+        with self.lock:
+            for key in keys:
+                self.pending.add(key)
+        if bitmap_key and keys:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                for pos in self.pending.positions(key):
+                    pipe.setbit(bitmap_key, pos, 1)
+            pipe.execute()
+
+    def _run(self):
+        ''' Initial build, then periodic syncs and rebuilds '''
+        last_rebuild = time.time()
+        while not self.stopped.is_set():
+            try:
+                if not self.ready:
+                    if self.shared and self.redis.exists(self.active_key):
+                        self.sync()
+                    else:
+                        self.rebuild()
+                    last_rebuild = time.time()
+                elif time.time() - last_rebuild >= self.rebuild_interval:
+                    # Also picks up keys written by other processes when not shared
+                    self.rebuild()
+                    last_rebuild = time.time()
+                elif self.shared:
+                    self.sync()
+            except Exception:
+                # Keep answering from the current filter, retry later
+                pass
+            self.stopped.wait(self.sync_interval if self.shared else min(self.sync_interval, self.rebuild_interval))
@@ -5,9 +5,180 @@ Created on Feb 24, 2012
 @author: Benjamin Dezile
 '''
 
-from cStringIO import StringIO
+from pyutils.lib.codec import ReprCodec, CompressedCodec, DEFAULT_COMPRESS_THRESHOLD
+from pyutils.lib.local_cache import LocalCache, DEFAULT_CHANNEL
+from pyutils.lib.shard import ShardedRedis, hash_tag, DEFAULT_REPLICAS
+from pyutils.lib.cache_stats import CacheStats
+from pyutils.lib.bloom import KeyFilter, DEFAULT_CAPACITY, DEFAULT_ERROR_RATE, DEFAULT_SYNC_INTERVAL, DEFAULT_REBUILD_INTERVAL
+from contextlib import contextmanager
+from copy import copy
+from hashlib import sha1
+from urllib import quote
+import threading
 import redis
-import uuid
+import time
+
+
+# Server-side scripts for compound operations, each run atomically in one round trip
+
+# Put a string in a key of any type. KEYS: key, ARGV: value, ttl
+LUA_PUT_STR = """
+local t = redis.call('TYPE', KEYS[1]).ok
+if t == 'list' then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+elseif t == 'set' then
+    redis.call('SADD', KEYS[1], ARGV[1])
+elseif t == 'hash' then
+    return redis.error_reply('Cannot add a string to a hash')
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return t
+"""
+
+# Read a key of any type and delete it. KEYS: key
+LUA_GET_DEL = """
+local t = redis.call('TYPE', KEYS[1]).ok
+local v
+if t == 'string' then
+    v = redis.call('GET', KEYS[1])
+elseif t == 'hash' then
+    v = redis.call('HGETALL', KEYS[1])
+elseif t == 'list' then
+    v = redis.call('LRANGE', KEYS[1], 0, -1)
+elseif t == 'set' then
+    v = redis.call('SMEMBERS', KEYS[1])
+elseif t == 'zset' then
+    v = redis.call('ZRANGE', KEYS[1], 0, -1)
+else
+    return {t}
+end
+redis.call('DEL', KEYS[1])
+return {t, v}
+"""
+
+# Scan one batch of keys matching a pattern and delete them. ARGV: cursor, pattern, count
+LUA_SCAN_DEL = """
+pcall(redis.replicate_commands)
+local res = redis.call('SCAN', ARGV[1], 'MATCH', ARGV[2], 'COUNT', ARGV[3])
+local keys = res[2]
+for i = 1, #keys, 1000 do
+    local batch = {unpack(keys, i, math.min(i + 999, #keys))}
+    local n = redis.pcall('UNLINK', unpack(batch))
+    if type(n) == 'table' and n.err then
+        redis.call('DEL', unpack(batch))
+    end
+end
+return {res[1], keys}
+"""
+
+# Store the union or intersection of sets with a ttl, or reuse the stored result.
+# KEYS: destination, sources..., dependency sets of the sources...
+# ARGV: UNION|INTER, ttl, aggregate, reuse (0|1), number of sources, weights...
+LUA_SET_OP_STORE = """
+if ARGV[4] == '1' then
+    local t = redis.call('TYPE', KEYS[1]).ok
+    if t == 'set' then
+        return redis.call('SCARD', KEYS[1])
+    elseif t == 'zset' then
+        return redis.call('ZCARD', KEYS[1])
+    end
+end
+local n = tonumber(ARGV[5])
+local zset = false
+for i = 2, n + 1 do
+    local t = redis.call('TYPE', KEYS[i]).ok
+    if t == 'zset' then
+        zset = zset or i == 2
+    elseif t ~= 'set' and t ~= 'none' then
+        return redis.error_reply(KEYS[i] .. ' must be a set')
+    end
+end
+local card
+if zset then
+    local args = {KEYS[1], n}
+    for i = 2, n + 1 do
+        args[#args + 1] = KEYS[i]
+    end
+    if #ARGV > 5 then
+        args[#args + 1] = 'WEIGHTS'
+        for i = 6, #ARGV do
+            args[#args + 1] = ARGV[i]
+        end
+    end
+    args[#args + 1] = 'AGGREGATE'
+    args[#args + 1] = ARGV[3]
+    card = redis.call('Z' .. ARGV[1] .. 'STORE', unpack(args))
+else
+    card = redis.call('S' .. ARGV[1] .. 'STORE', KEYS[1], unpack(KEYS, 2, n + 1))
+end
+if card > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    for i = n + 2, #KEYS do
+        redis.call('SADD', KEYS[i], KEYS[1])
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    end
+end
+return card
+"""
+
+# Count the members of the union or intersection of sets without storing it.
+# KEYS: sources, ARGV: UNION|INTER
+LUA_SET_OP_CARD = """
+local counts = {}
+local n = 0
+for i = 1, #KEYS do
+    local t = redis.call('TYPE', KEYS[i]).ok
+    local members = {}
+    if t == 'set' then
+        members = redis.call('SMEMBERS', KEYS[i])
+    elseif t == 'zset' then
+        members = redis.call('ZRANGE', KEYS[i], 0, -1)
+    elseif t ~= 'none' then
+        return redis.error_reply(KEYS[i] .. ' must be a set')
+    end
+    for _, m in ipairs(members) do
+        local c = (counts[m] or 0) + 1
+        counts[m] = c
+        if (ARGV[1] == 'UNION' and c == 1) or (ARGV[1] == 'INTER' and c == #KEYS) then
+            n = n + 1
+        end
+    end
+end
+return n
+"""
+
+def instrumented(op):
+    ''' Decorator recording calls to a Cache method when stats are enabled '''
+    def decorator(f):
+        def wrapper(cls, *args, **kw):
+            stats = cls.stats
+            if stats is None:
+                return f(cls, *args, **kw)
+            key = args[0] if args and isinstance(args[0], basestring) else None
+            if op == "get_many":
+                args = (list(args[0]),) + args[1:]
+            start = time.time()
+            try:
+                res = f(cls, *args, **kw)
+            except Exception:
+                stats.record(op, time.time() - start, key, True)
+                raise
+            stats.record(op, time.time() - start, key)
+            if op == "get":
+                stats.lookup(key, res is not None)
+            elif op == "get_many":
+                for (k, v) in zip(args[0], res):
+                    stats.lookup(k, v is not None)
+            return res
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+    return decorator
+
 
 class Cache:
     ''' Caching wrapper built on top Redis
@@ -33,56 +204,386 @@ class Cache:
     REDIS_TYPE_SET = "set"
     REDIS_TYPE_SORTED_SET = "zset"
     KEY_DEFAULT_TTL = 3600
+    SCAN_COUNT = 1000
+    KEY_MAX_LENGTH = None
+    SET_OP_PREFIX = "setop:"
+    SET_OP_DEPS_PREFIX = "setop-deps:"
     DEFAULT_PORT = 6379
     DEFAULT_HOST = "localhost"
+    DEFAULT_POOL_SIZE = 64
     
     instance = None
+    pools = dict()
+    pools_lock = threading.Lock()
+    codec = ReprCodec()
+    local = None
+    stats = None
+    key_filters = None
+    has_unlink = True
+    has_scripting = None
+    reuse_set_ops = False
+    scripts = {"put_str": LUA_PUT_STR,
+               "get_del": LUA_GET_DEL,
+               "scan_del": LUA_SCAN_DEL,
+               "set_op_store": LUA_SET_OP_STORE,
+               "set_op_card": LUA_SET_OP_CARD}
+    script_shas = dict([(name, sha1(src).hexdigest()) for (name, src) in scripts.items()])
     
     def __init__(self, **kw):
         self.host = kw.get('host', Cache.DEFAULT_HOST)
         self.port = kw.get('port', Cache.DEFAULT_PORT)
-        self.db_index = kw.get('db', 0)
-        self.redis = redis.StrictRedis(host=self.host, port=self.port)
-        # XXX: Not implemented in lib yet
-        #if self.db_index > 0:
-        #    self.redis.select(self.db_index)
+        self.db_index = kw.get('db', kw.get('index', 0))
+        self.nodes = kw.get('nodes', None)
+        pool_size = kw.get('pool_size', None)
+        if kw.get('client'):
+            # Any client implementing the StrictRedis commands used here
+            self.redis = kw['client']
+        elif self.nodes:
+            # Sharded across several nodes
+            clients = dict()
+            for node in self.nodes:
+                (host, port) = node.split(":") if isinstance(node, basestring) else node
+                pool = Cache.get_pool(host, port, self.db_index, pool_size)
+                clients["%s:%s" % (host, port)] = redis.StrictRedis(connection_pool=pool)
+            self.redis = ShardedRedis(clients, kw.get('replicas', DEFAULT_REPLICAS))
+        else:
+            pool = Cache.get_pool(self.host, self.port, self.db_index, pool_size)
+            self.redis = redis.StrictRedis(connection_pool=pool)
         self.instance = self
     
     @classmethod
-    def init(cls, host=None, port=None, index=None):
-        ''' Initialized the cache instance '''
+    def init(cls, host=None, port=None, index=None, pool_size=None, nodes=None, client=None):
+        ''' Initialized the cache instance 
+        nodes:      List of "host:port" or (host, port) to shard keys across 
+                    with consistent hashing (host and port are then ignored).
+                    Keys sharing a {hash tag} always live on the same node.
+        client:     Backend to use instead of connecting to Redis, e.g. a MemoryRedis
+                    (all other parameters are then ignored)
+        '''
         params = dict()
         if host:
             params['host'] = host
         if port:
             params['port'] = port
         if index:
-            params['index'] = index
-        Cache(**params)
+            params['db'] = index
+        if pool_size:
+            params['pool_size'] = pool_size
+        if nodes:
+            params['nodes'] = nodes
+        if client:
+            params['client'] = client
+        cls.instance = Cache(**params)
+        # Probe the new backend's capabilities again
+        cls.has_unlink = True
+        cls.has_scripting = None
+    
+    @classmethod
+    def get_pool(cls, host, port, db=0, size=None):
+        ''' Return the connection pool shared by all instances
+        using the same server and database, creating it if needed.
+        size:       Maximum number of connections (None = DEFAULT_POOL_SIZE on creation,
+                    unchanged otherwise). An existing pool is resized in place.
+        '''
+        pool_key = (host, int(port), int(db))
+        pool = cls.pools.get(pool_key)
+        if pool is None or (size and size != pool.max_connections):
+            with cls.pools_lock:
+                pool = cls.pools.get(pool_key)
+                if pool is None:
+                    pool = redis.ConnectionPool(host=host, port=int(port), db=int(db), 
+                                                max_connections=size or cls.DEFAULT_POOL_SIZE)
+                    cls.pools[pool_key] = pool
+                elif size:
+                    # Connections beyond a smaller size are only closed on disconnect
+                    pool.max_connections = size
+        return pool
+    
+    @classmethod
+    def pool_stats(cls):
+        ''' Return connection usage for each pool, keyed by "host:port/db" '''
+        stats = dict()
+        for (host, port, db) in cls.pools.keys():
+            pool = cls.pools[(host, port, db)]
+            stats["%s:%s/%s" % (host, port, db)] = {'max': pool.max_connections,
+                                                    'created': pool._created_connections,
+                                                    'in_use': len(pool._in_use_connections),
+                                                    'available': len(pool._available_connections)}
+        return stats
+    
+    @classmethod
+    def set_codec(cls, codec):
+        ''' Set the codec used to encode values (see pyutils.lib.codec).
+        Values written by any other registered codec remain readable.
+        '''
+        cls.codec = codec
+    
+    @classmethod
+    def enable_stats(cls):
+        ''' Start recording hits, misses, errors, bytes read/written 
+        per namespace and latencies per operation 
+        '''
+        cls.stats = CacheStats(cls.NS_PREFIXES)
+    
+    @classmethod
+    def disable_stats(cls):
+        ''' Stop recording stats '''
+        cls.stats = None
+    
+    @classmethod
+    def stats_snapshot(cls):
+        ''' Return a copy of the current stats (see CacheStats.snapshot), 
+        None if stats are disabled
+        '''
+        if cls.stats:
+            return cls.stats.snapshot()
+    
+    @classmethod
+    def enable_compression(cls, threshold=DEFAULT_COMPRESS_THRESHOLD, level=1, algorithm="zlib"):
+        ''' Compress values (or list, set and hash items) larger than a threshold.
+        Compressed values are marked with a header and read back transparently,
+        whether compression is enabled or not.
+        threshold:  Minimum size in bytes of a value to compress it
+        level:      Compression level (zlib only)
+        algorithm:  "zlib" or "lz4"
+        '''
+        cls.disable_compression()
+        cls.codec = CompressedCodec(cls.codec, threshold, level, algorithm)
+    
+    @classmethod
+    def disable_compression(cls):
+        ''' Stop compressing values '''
+        if isinstance(cls.codec, CompressedCodec):
+            cls.codec = cls.codec.codec
+    
+    @classmethod
+    def compression_stats(cls):
+        ''' Return compression stats, None if compression is disabled '''
+        if isinstance(cls.codec, CompressedCodec):
+            return cls.codec.stats()
+    
+    @classmethod
+    def enable_local(cls, max_entries=10000, max_bytes=None, ttl=60, namespaces=None, channel=DEFAULT_CHANNEL):
+        ''' Serve reads from a bounded in-process tier in front of Redis.
+        Local entries never outlive their Redis ttl and are invalidated
+        by put, remove and remove_from, in every process listening on channel.
+        max_entries:    Maximum number of local entries
+        max_bytes:      Maximum total size of local entries (None = Unbounded)
+        ttl:            Maximum time to live of a local entry in seconds
+        namespaces:     Only cache keys from these namespaces (None = All)
+        channel:        Pub/sub channel used to broadcast invalidations (None = Disabled)
+        '''
+        cls.disable_local()
+        prefixes = [cls.NS_PREFIXES[ns] for ns in namespaces] if namespaces else None
+        local = LocalCache(max_entries, max_bytes, ttl, prefixes)
+        if channel:
+            local.subscribe(cls.instance.redis, channel)
+        cls.local = local
+    
+    @classmethod
+    def disable_local(cls):
+        ''' Stop using the in-process tier '''
+        if cls.local:
+            cls.local.close()
+            cls.local = None
+    
+    @classmethod
+    def enable_key_filter(cls, namespaces=None, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, shared=True, 
+                          sync_interval=DEFAULT_SYNC_INTERVAL, rebuild_interval=DEFAULT_REBUILD_INTERVAL):
+        ''' Answer lookups of absent keys without a round trip, using a Bloom filter 
+        of the keys of each namespace (see pyutils.lib.bloom). Filters are built in the 
+        background and only used once ready.
+        namespaces:         Namespaces to filter (None = All)
+        capacity:           Expected number of keys per namespace
+        error_rate:         Rate of absent keys that still cost a lookup
+        shared:             Whether to keep the filters in Redis, so that keys written by other 
+                            processes are seen (within sync_interval). Without it, keys written
+                            by other processes are only seen after the next rebuild, so all writes 
+                            to the namespaces should go through this process.
+        sync_interval:      Time in seconds between reloads of shared filters
+        rebuild_interval:   Time in seconds between rebuilds, dropping removed and expired keys
+        '''
+        cls.disable_key_filter()
+        prefixes = [cls.NS_PREFIXES[ns] for ns in (namespaces or cls.NS_PREFIXES.keys())]
+        cls.key_filters = dict((prefix, KeyFilter(cls.instance.redis, prefix, capacity, error_rate, shared, 
+                                                  sync_interval, rebuild_interval)) for prefix in prefixes)
+    
+    @classmethod
+    def disable_key_filter(cls):
+        ''' Stop using key filters '''
+        if cls.key_filters:
+            for f in cls.key_filters.values():
+                f.close()
+            cls.key_filters = None
+    
+    @classmethod
+    def _key_filter(cls, key):
+        ''' Return the filter of the namespace of a key, None if not filtered '''
+        filters = cls.key_filters
+        if filters:
+            for prefix in filters:
+                if key.startswith(prefix):
+                    return filters[prefix]
+        return None
+    
+    @classmethod
+    def _known_absent(cls, key):
+        ''' Return whether a key is known not to exist, without a round trip '''
+        f = cls._key_filter(key)
+        return f is not None and not f.might_contain(key)
+    
+    @classmethod
+    @contextmanager
+    def _tracking(cls, keys):
+        ''' Add keys about to be written to their key filters, 
+        for the duration of the write (used as a context manager)
+        '''
+        groups = dict()
+        for key in (keys if cls.key_filters else ()):
+            f = cls._key_filter(key)
+            if f is not None:
+                groups.setdefault(f, list()).append(key)
+        added = list()
+        try:
+            for f in groups:
+                f.add(groups[f])
+                added.append(f)
+            yield
+        finally:
+            for f in added:
+                f.added(groups[f])
+    
+    @classmethod
+    def enable_set_op_reuse(cls):
+        ''' Reuse stored union and intersection results while their inputs are unchanged.
+        Results are dropped whenever one of their inputs is written to or removed through
+        Cache, so this must be enabled in every process writing to these inputs.
+        '''
+        cls.reuse_set_ops = True
+    
+    @classmethod
+    def disable_set_op_reuse(cls):
+        ''' Always recompute union and intersection results '''
+        cls.reuse_set_ops = False
+    
+    @classmethod
+    def _invalidate(cls, keys, patterns=()):
+        ''' Drop keys and key patterns from the in-process tier,
+        and the stored set operation results depending on them.
+        Only patterns cost a scan, keys are taken as is even if they contain wildcards.
+        keys:       Written or removed keys
+        patterns:   Removed key patterns
+        '''
+        if cls.local:
+            cls.local.invalidate(keys, patterns)
+        if cls.reuse_set_ops:
+            cls._drop_set_op_results(keys, patterns)
     
     @classmethod
-    def make_ns_key(cls, ns, controller_name, action_name, params=None):
-        ''' Build a namespaced cache key '''
-        buf = StringIO()
-        buf.write("%s%s%s" % (cls.NS_PREFIXES[ns], controller_name, "_" + action_name if action_name else ""))
+    def _drop_set_op_results(cls, keys, patterns=()):
+        ''' Delete the stored set operation results depending on keys or key patterns '''
+        r = cls.instance.redis
+        deps_keys = [cls._deps_key(k) for k in keys]
+        for p in patterns:
+            # Keys may contain wildcards too
+            deps_keys.append(cls._deps_key(p))
+            for pattern in set([cls.SET_OP_DEPS_PREFIX + p, cls._deps_key(p)]):
+                deps_keys.extend(cls.iter_keys(pattern))
+        deps_keys = list(set(deps_keys))
+        if not deps_keys:
+            return
+        pipe = r.pipeline(transaction=False)
+        for key in deps_keys:
+            pipe.smembers(key)
+        results = set()
+        for members in pipe.execute():
+            results.update(members)
+        if results:
+            # Empty dependency sets do not exist
+            cls._unlink(r, list(results) + deps_keys)
+    
+    @classmethod
+    def _sizeof(cls, v):
+        ''' Approximate size in bytes of a raw value '''
+        t = type(v)
+        if t == dict:
+            return sum(len(k) + len(v[k]) for k in v)
+        elif t == list or t == set:
+            return sum(len(x) for x in v)
+        return len(v) if v else 0
+    
+    @classmethod
+    def _encoded_size(cls, items):
+        ''' Approximate size in bytes of encoded values '''
+        return sum(len(x) if isinstance(x, basestring) else len(str(x)) for x in items)
+    
+    @classmethod
+    def make_ns_key(cls, ns, controller_name, action_name, params=None, **options):
+        ''' Build a namespaced cache key 
+        ns:                 Namespace (see NS_PREFIXES)
+        controller_name:    Controller name
+        action_name:        Action name (optional)
+        params:             Request parameters, always written in sorted order
+        options:            Additional options
+                            - strict: escape names and values and keep falsy values 
+                              (except None) so that distinct params never share a key
+                            - max_length: replace the params of longer keys with 
+                              a fixed-length digest (default: KEY_MAX_LENGTH)
+        '''
+        base = cls._ns_key_base(ns, controller_name, action_name)
+        return cls._make_ns_key(base, params, options.get('strict', False), options.get('max_length', cls.KEY_MAX_LENGTH))
+    
+    @classmethod
+    def make_ns_keys(cls, ns, controller_name, action_name, params_list, **options):
+        ''' Build the namespaced cache keys of an action 
+        for several sets of parameters (see make_ns_key) 
+        '''
+        base = cls._ns_key_base(ns, controller_name, action_name)
+        strict = options.get('strict', False)
+        max_length = options.get('max_length', cls.KEY_MAX_LENGTH)
+        return [cls._make_ns_key(base, params, strict, max_length) for params in params_list]
+    
+    @classmethod
+    def _ns_key_base(cls, ns, controller_name, action_name):
+        ''' Return the namespaced part of a key, before any params '''
+        return "%s%s%s" % (cls.NS_PREFIXES[ns], cls._key_part(controller_name),
+                           "_" + cls._key_part(action_name) if action_name else "")
+    
+    @classmethod
+    def _make_ns_key(cls, base, params, strict, max_length):
+        ''' Append params to a namespaced key '''
+        cache_key = base
         if params:
-            buf.write("?")
-            for k in params:
-                if params[k]:
-                    buf.write(k)
-                    buf.write("=")
-                    buf.write(str(params[k]))
-                    buf.write("&")
-        cache_key = buf.getvalue().rstrip("&")
-        buf.close()
+            parts = list()
+            for k in sorted(params):
+                v = params[k]
+                if (v is not None) if strict else v:
+                    parts.append("%s=%s" % (cls._key_part(k, strict), cls._key_part(v, strict)))
+            cache_key = "%s?%s" % (base, "&".join(parts))
+        if max_length and len(cache_key) > max_length:
+            cache_key = "%s#%s" % (base, sha1(cache_key).hexdigest())
         return cache_key
     
+    @classmethod
+    def _key_part(cls, v, escape=False):
+        ''' Convert a param name or value to a key string '''
+        t = type(v)
+        if t == unicode:
+            v = v.encode('utf-8')
+        elif t != str:
+            v = str(v)
+        return quote(v, safe='') if escape else v
+    
     @classmethod
     def get_instance(cls, **kw):
-        ''' Return the cache instance '''
-        return Cache(**kw)
+        ''' Return the cache instance, or an instance for 
+        another server or database if any parameters are given.
+        Instances with the same parameters share their connections.
+        '''
+        return Cache(**kw) if kw else cls.instance
         
     @classmethod
+    @instrumented("put")
     def put(cls, key, obj, ttl=None, **options):
         ''' Put a new value in cache 
         key:        Storage key
@@ -90,105 +591,357 @@ class Cache:
         ttl:        Time to live in seconds (None = Infinity)
         options:    Additional options
                     - sorted: whether it's a set of sorted values
+                    - atomic: whether to write the value and its ttl 
+                      in a single MULTI/EXEC transaction
         ''' 
         r = cls.instance.redis
         t = type(obj)
-        tc = r.type(key)
+        is_str = (t == str or t == unicode)
+        atomic = options.get('atomic', False) is True
+        with cls._tracking([key]):
+            if is_str and cls._use_scripts():
+                # Probe the type and write in one atomic round trip
+                v = cls.codec.encode(obj)
+                cls._run_script("put_str", [key], [v, ttl or 0])
+                if cls.stats:
+                    cls.stats.written(key, cls._encoded_size([v]))
+            elif is_str and atomic:
+                # Probe the type under WATCH so the write is retried if the key changes
+                def queue(pipe):
+                    tc = pipe.type(key)
+                    pipe.multi()
+                    cls._queue_put(pipe, key, obj, tc, ttl, **options)
+                r.transaction(queue, key)
+            else:
+                # Only strings need a type probe, everything else goes in one batch
+                tc = r.type(key) if is_str else None
+                pipe = r.pipeline(transaction=atomic)
+                cls._queue_put(pipe, key, obj, tc, ttl, **options)
+                pipe.execute()
+        cls._invalidate([key])
+    
+    @classmethod
+    def _queue_put(cls, pipe, key, obj, tc=None, ttl=None, **options):
+        ''' Queue the commands needed to put a value on a pipeline 
+        pipe:       Pipeline to queue commands on
+        key:        Storage key
+        obj:        Value
+        tc:         Current type of the key (only needed for strings)
+        ttl:        Time to live in seconds (None = Infinity)
+        options:    Same as put
+        '''
+        t = type(obj)
+        enc = cls.codec.encode
         
         if t == str or t == unicode:
             if tc == cls.REDIS_TYPE_HASH:
                 # Add a string to a hash
-                r.hmset(key, obj)
-            elif tc == cls.REDIS_TYPE_LIST:
-                # Add a string to a list
-                r.rpush(key, obj)
-            elif tc == cls.REDIS_TYPE_SET:
-                # Add a string to a set
-                r.sadd(key, obj)
+                pipe.hmset(key, obj)
+                items = [obj]
             else:
-                # Set a string key
-                r.set(key, obj)
+                items = [enc(obj)]
+                if tc == cls.REDIS_TYPE_LIST:
+                    # Add a string to a list
+                    pipe.rpush(key, items[0])
+                elif tc == cls.REDIS_TYPE_SET:
+                    # Add a string to a set
+                    pipe.sadd(key, items[0])
+                else:
+                    # Set a string key
+                    pipe.set(key, items[0])
         elif t == dict:
             if options.get('sorted', False) is True:
                 # Add values to a sorted set
-                r.zadd(key, **obj)
+                pipe.zadd(key, **obj)
+                items = obj.keys()
             else:
                 # Add values to a hash
-                r.hmset(key, obj)
+                mapping = dict((k, enc(obj[k])) for k in obj)
+                pipe.hmset(key, mapping)
+                items = mapping.keys() + mapping.values()
         elif t == list:
             # Add values to a list
-            for x in obj: 
-                r.rpush(key, x)
+            items = [enc(x) for x in obj]
+            if items:
+                pipe.rpush(key, *items)
         elif t == set:
             # Add values to a set
-            r.sadd(key, *obj)
+            items = [enc(x) for x in obj]
+            pipe.sadd(key, *items)
         else:
             raise ValueError("Unsupported type of cache object: " + str(type(obj)))
         
+        if cls.stats:
+            cls.stats.written(key, cls._encoded_size(items))
+        
         if ttl:
-            r.expire(key, ttl)
+            pipe.expire(key, ttl)
+    
+    @classmethod
+    @instrumented("put_many")
+    def put_many(cls, mapping, ttl=None, **options):
+        ''' Put several values in cache at once.
+        All writes are sent in a single batch (plus one type probe
+        batch if any of the values are strings).
+        mapping:    Map of storage keys to values
+        ttl:        Time to live in seconds (None = Infinity)
+        options:    Same as put
+        '''
+        r = cls.instance.redis
+        if not mapping:
+            return
+        with cls._tracking(mapping.keys()):
+            # Probe the types of string values in one batch
+            str_keys = [k for k in mapping if type(mapping[k]) in (str, unicode)]
+            types = dict()
+            if str_keys:
+                pipe = r.pipeline(transaction=False)
+                for key in str_keys:
+                    pipe.type(key)
+                types = dict(zip(str_keys, pipe.execute()))
+        
+            pipe = r.pipeline(transaction=options.get('atomic', False) is True)
+            for key in mapping:
+                cls._queue_put(pipe, key, mapping[key], types.get(key), ttl, **options)
+            pipe.execute()
+        cls._invalidate(mapping.keys())
     
     @classmethod
+    @instrumented("keys")
     def keys(cls, pattern):
         ''' Return the list of keys matching the given pattern '''
+        keys = list()
+        seen = set()
+        for key in cls.iter_keys(pattern):
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        return keys
+    
+    @classmethod
+    def iter_keys(cls, pattern, count=SCAN_COUNT):
+        ''' Iterate over the keys matching the given pattern 
+        without blocking the server. A key may be returned more than once.
+        pattern:    Key pattern
+        count:      Number of keys to scan per round trip
+        '''
         r = cls.instance.redis
-        return r.keys(pattern)
+        return r.scan_iter(match=pattern, count=count)
     
     @classmethod
+    @instrumented("get")
     def get(cls, key, **options):
         ''' Get a cache value, None if not found 
         key:         Key to read from
         options:     Additional options
-                     - range: range of indexes to get from a sorted set
-                     - score_range: same but with scores
+                     - range: range of indexes to get from a list or sorted set
+                     - score_range: same but with scores (sorted sets only)
                      - no_eval: return data as is if True
         '''
         
         r = cls.instance.redis
-        t = r.type(key)
-        no_eval = options.get("no_eval", False)
+        local = cls.local if cls.local and not options and cls.local.accepts(key) else None
+        
+        if cls.key_filters and cls._known_absent(key):
+            return None
+        
+        if local:
+            v = local.get(key)
+            if v is not None:
+                return copy(v)
+            # Not cached if invalidated while reading
+            version = local.version(key)
+            # Probe the ttl along with the type to cap the local one
+            pipe = r.pipeline(transaction=False)
+            pipe.type(key)
+            pipe.pttl(key)
+            (t, pttl) = pipe.execute()
+        else:
+            t = r.type(key)
         
         if t == cls.REDIS_TYPE_NONE:
-            
             # None
             return None
         
+        v = cls._read(r, key, t, **options)
+        if cls.stats:
+            cls.stats.read(key, cls._sizeof(v))
+        if local and v:
+            size = cls._sizeof(v)
+            v = cls._decode(t, v, **options)
+            if v is not None:
+                local.set(key, v, size, pttl / 1000.0 if pttl > 0 else None, version)
+                return copy(v)
+            return v
+        
+        return cls._decode(t, v, **options)
+    
+    @classmethod
+    @instrumented("get_many")
+    def get_many(cls, keys, **options):
+        ''' Get several cache values at once, in two round trips.
+        Return the list of values in the same order as keys, 
+        None for any key that is not found.
+        keys:        Keys to read from
+        options:     Same as get
+        '''
+        
+        r = cls.instance.redis
+        keys = list(keys)
+        vals = [None] * len(keys)
+        local = cls.local if cls.local and not options else None
+        
+        # Serve what we can from the in-process tier
+        fetch_idx = range(len(keys))
+        versions = dict()
+        if local:
+            fetch_idx = list()
+            for i in range(len(keys)):
+                v = local.get(keys[i]) if local.accepts(keys[i]) else None
+                if v is None:
+                    fetch_idx.append(i)
+                    versions[i] = local.version(keys[i])
+                else:
+                    vals[i] = copy(v)
+        if cls.key_filters:
+            fetch_idx = [i for i in fetch_idx if not cls._known_absent(keys[i])]
+        if not fetch_idx:
+            return vals
+        
+        (types, ttls, raw) = cls._read_many(r, [keys[i] for i in fetch_idx], local is not None, **options)
+        for j in range(len(fetch_idx)):
+            (i, v) = (fetch_idx[j], raw[j])
+            if v is None:
+                continue
+            size = cls._sizeof(v) if local or cls.stats else 0
+            if cls.stats:
+                cls.stats.read(keys[i], size)
+            v = cls._decode(types[j], v, **options)
+            if local and v is not None and local.accepts(keys[i]):
+                local.set(keys[i], v, size, ttls[j] / 1000.0 if ttls[j] > 0 else None, versions[i])
+                v = copy(v)
+            vals[i] = v
+        return vals
+    
+    @classmethod
+    def _peek(cls, r, key):
+        ''' Read a value without recording a lookup, None if not found '''
+        (types, _, raw) = cls._read_many(r, [key])
+        if types[0] == cls.REDIS_TYPE_NONE:
+            return None
+        if cls.stats:
+            cls.stats.read(key, cls._sizeof(raw[0]))
+        return cls._decode(types[0], raw[0])
+    
+    @classmethod
+    def _read_many(cls, r, keys, with_ttls=False, **options):
+        ''' Read the raw values of several keys in two round trips.
+        Return the lists of their types, ttls in milliseconds (None unless with_ttls)
+        and raw values (None for keys that are missing or changed type since the probe).
+        '''
+        
+        # Probe all types (and ttls if needed) in one batch
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+            if with_ttls:
+                pipe.pttl(key)
+        res = pipe.execute()
+        step = 2 if with_ttls else 1
+        types = res[::step]
+        ttls = res[1::step] if with_ttls else [None] * len(keys)
+        
+        # Strings are read with a single MGET, everything else is pipelined
+        idx = range(len(keys))
+        str_idx = [i for i in idx if types[i] == cls.REDIS_TYPE_STR]
+        other_idx = [i for i in idx if types[i] not in (cls.REDIS_TYPE_STR, cls.REDIS_TYPE_NONE)]
+        pipe = r.pipeline(transaction=False)
+        if str_idx:
+            pipe.mget([keys[i] for i in str_idx])
+        for i in other_idx:
+            cls._read(pipe, keys[i], types[i], **options)
+        res = pipe.execute(False) if str_idx or other_idx else list()
+        
+        raw = [None] * len(keys)
+        if str_idx:
+            strs = res.pop(0)
+            if not isinstance(strs, Exception):
+                for (i, v) in zip(str_idx, strs):
+                    raw[i] = v
+        for (i, v) in zip(other_idx, res):
+            # A key that changed type since the probe is treated as a miss
+            if not isinstance(v, Exception):
+                raw[i] = v
+        return (types, ttls, raw)
+    
+    @classmethod
+    def iter(cls, key, batch=SCAN_COUNT):
+        ''' Iterate over a cache value without loading it all at once.
+        Yield list items, set members, (field, value) pairs for hashes
+        and (member, score) pairs for sorted sets, decoded as they come.
+        Hashes, sets and sorted sets are scanned, so an item modified 
+        while iterating may be returned more than once.
+        key:         Key to read from
+        batch:       Number of items to fetch per round trip
+        '''
+        r = cls.instance.redis
+        t = r.type(key)
+        dec = cls.codec.decode
+        
+        if t == cls.REDIS_TYPE_LIST:
+            # List, read in pages
+            start = 0
+            while True:
+                items = r.lrange(key, start, start + batch - 1)
+                if cls.stats:
+                    cls.stats.read(key, cls._sizeof(items))
+                for x in items:
+                    yield dec(x)
+                if len(items) < batch:
+                    break
+                start += batch
         elif t == cls.REDIS_TYPE_HASH:
-            
             # Hash
-            d = r.hgetall(key)
-            if d:
-                for k in d:
-                    d[k] = cls._eval(d[k])
-                return d
-            
+            for (k, v) in r.hscan_iter(key, count=batch):
+                yield (k, dec(v))
+        elif t == cls.REDIS_TYPE_SET:
+            # Set
+            for x in r.sscan_iter(key, count=batch):
+                yield dec(x)
+        elif t == cls.REDIS_TYPE_SORTED_SET:
+            # Sorted set
+            for x in r.zscan_iter(key, count=batch):
+                yield x
         elif t == cls.REDIS_TYPE_STR:
-            
             # String
-            s = r.get(key)
-            return cls._eval(s) if s and not no_eval else s
-            
+            v = r.get(key)
+            if cls.stats:
+                cls.stats.read(key, cls._sizeof(v))
+            yield cls._decode(t, v)
+    
+    @classmethod
+    def _read(cls, r, key, t, **options):
+        ''' Issue the read command for a key of a given type.
+        Works with a client as well as with a pipeline.
+        r:           Redis client or pipeline
+        key:         Key to read from
+        t:           Type of the key
+        options:     Same as get
+        '''
+        
+        if t == cls.REDIS_TYPE_HASH:
+            # Hash
+            return r.hgetall(key)
+        elif t == cls.REDIS_TYPE_STR:
+            # String
+            return r.get(key)
         elif t == cls.REDIS_TYPE_LIST:
-            
             # List
-            l = r.lrange(key, 0, -1)
-            if l:
-                for i in range(0, len(l)):
-                    l[i] = cls._eval(l[i])
-                return l
-            
+            return r.lrange(key, *(options.get('range') or (0, -1)))
         elif t == cls.REDIS_TYPE_SET:
-            
             # Set
-            s1 = r.smembers(key)
-            if s1:
-                s2 = set()
-                for x in s1:
-                    s2.add(cls._eval(x))
-                return s2
-            
+            return r.smembers(key)
         elif t == cls.REDIS_TYPE_SORTED_SET:
-            
             # Sorted set
             rng = options.get('range', (0, -1))
             srng = options.get('score_range', None)
@@ -198,47 +951,194 @@ class Cache:
                 return r.zrange(key, *rng)
             else:
                 raise ValueError('No range info found')
-            
         else:
-            
             # Unknown
             raise ValueError('Unknown key type:' + str(t)) 
     
     @classmethod
-    def _eval(cls, v):
-        ''' Evaluate a given value '''
-        try:
-            return eval(v)
-        except:
+    def _decode(cls, t, v, **options):
+        ''' Decode a raw value read from a key of a given type '''
+        
+        no_eval = options.get("no_eval", False)
+        
+        if t == cls.REDIS_TYPE_HASH:
+            
+            # Hash
+            if v:
+                dec = cls.codec.decode
+                for k in v:
+                    v[k] = dec(v[k])
+                return v
+            
+        elif t == cls.REDIS_TYPE_STR:
+            
+            # String
+            return cls._eval(v) if v and not no_eval else v
+            
+        elif t == cls.REDIS_TYPE_LIST:
+            
+            # List
+            if v:
+                return map(cls.codec.decode, v)
+            
+        elif t == cls.REDIS_TYPE_SET:
+            
+            # Set
+            if v:
+                return set(map(cls.codec.decode, v))
+            
+        elif t == cls.REDIS_TYPE_SORTED_SET:
+            
+            # Sorted set
             return v
     
     @classmethod
+    def _eval(cls, v):
+        ''' Decode a given value '''
+        return cls.codec.decode(v)
+    
+    @classmethod
+    @instrumented("has")
     def has(cls, key):
         ''' Return whether a key exists in cache '''
+        if cls.key_filters and cls._known_absent(key):
+            return False
         return cls.instance.redis.exists(key)
     
     @classmethod
-    def remove(cls, key_pattern, get_val=True):
+    @instrumented("remove")
+    def remove(cls, key_pattern, get_val=True, count=SCAN_COUNT, exact=False):
         ''' Remove a value from cache 
         key:      Storage key pattern
         get_val:  Whether to return the old value(s)   
+        count:    Number of keys to delete per batch
+        exact:    Whether key_pattern is a single key, even if it contains wildcards
+                  (e.g. a namespaced key with params), so that no scan is needed
         '''
-        r = cls.instance.redis
-        keys = r.keys(key_pattern) 
+        if exact or not cls._is_pattern(key_pattern):
+            # Single key, no need to scan
+            r = cls.instance.redis
+            if get_val and cls._use_scripts():
+                res = cls._get_del(key_pattern)
+            else:
+                res = cls._peek(r, key_pattern) if get_val else None
+                cls._unlink(r, [key_pattern])
+            cls._invalidate([key_pattern])
+            return res
         
-        if len(keys) == 1:
-            val = cls.get(keys[0]) if get_val else None
-            r.delete(keys[0])
-            return val
-        elif len(keys) > 1:
-            vals = list()
-            for key in keys:
-                if get_val:
-                    vals.append(cls.get(key))
-                r.delete(key)
-            return vals
+        vals = list()
+        for (_, val) in cls.iter_remove(key_pattern, get_val, count):
+            vals.append(val)
+        if len(vals) == 1:
+            return vals[0] if get_val else None
+        elif len(vals) > 1:
+            return vals if get_val else list()
+    
+    @classmethod
+    def iter_remove(cls, key_pattern, get_val=False, count=SCAN_COUNT):
+        ''' Remove all keys matching a pattern, in batches, as they are scanned.
+        Yield (key, old value) pairs as they are deleted (old value is None if not get_val).
+        key_pattern:    Storage key pattern
+        get_val:        Whether to read the old values
+        count:          Number of keys to delete per batch
+        '''
+        r = cls.instance.redis
+        try:
+            if not get_val and cls._use_scripts() and not isinstance(r, ShardedRedis):
+                # Scan and delete each batch in one round trip
+                cursor = 0
+                while True:
+                    (cursor, keys) = cls._run_script("scan_del", [], [cursor, key_pattern, count])
+                    for key in keys:
+                        yield (key, None)
+                    if int(cursor) == 0:
+                        return
+            
+            batch = list()
+            for key in cls.iter_keys(key_pattern, count):
+                batch.append(key)
+                if len(batch) >= count:
+                    for x in cls._remove_batch(r, batch, get_val):
+                        yield x
+                    batch = list()
+            if batch:
+                for x in cls._remove_batch(r, batch, get_val):
+                    yield x
+        finally:
+            cls._invalidate((), [key_pattern])
+    
+    @classmethod
+    def _remove_batch(cls, r, keys, get_val):
+        ''' Delete a batch of keys, return the list of (key, old value) pairs '''
+        keys = list(set(keys))
+        if not get_val:
+            cls._unlink(r, keys)
+            return [(k, None) for k in keys]
+        (types, _, raw) = cls._read_many(r, keys)
+        cls._unlink(r, keys)
+        res = list()
+        for (k, t, v) in zip(keys, types, raw):
+            # Keys seen twice by the scan are already gone
+            if t != cls.REDIS_TYPE_NONE:
+                if cls.stats:
+                    cls.stats.read(k, cls._sizeof(v))
+                res.append((k, cls._decode(t, v)))
+        return res
+    
+    @classmethod
+    def _unlink(cls, r, keys):
+        ''' Delete keys, reclaiming memory in the background if supported '''
+        if cls.has_unlink:
+            try:
+                return r.execute_command('UNLINK', *keys)
+            except redis.ResponseError:
+                cls.has_unlink = False
+        return r.delete(*keys)
+    
+    @classmethod
+    def _get_del(cls, key):
+        ''' Read and delete a key in one atomic round trip '''
+        res = cls._run_script("get_del", [key])
+        if len(res) < 2:
+            return None
+        (t, v) = res
+        if t == cls.REDIS_TYPE_HASH:
+            v = dict(zip(v[::2], v[1::2]))
+        if cls.stats:
+            cls.stats.read(key, cls._sizeof(v))
+        return cls._decode(t, v)
+    
+    @classmethod
+    def _use_scripts(cls):
+        ''' Return whether server-side scripts can be used.
+        Checked once, on first use.
+        '''
+        if cls.has_scripting is None:
+            try:
+                cls.instance.redis.script_exists(cls.script_shas["put_str"])
+                cls.has_scripting = True
+            except (redis.ResponseError, AttributeError, NotImplementedError):
+                cls.has_scripting = False
+        return cls.has_scripting
+    
+    @classmethod
+    def _run_script(cls, name, keys, args=()):
+        ''' Run one of the server-side scripts with EVALSHA, loading it if needed '''
+        r = cls.instance.redis
+        params = list(keys) + list(args)
+        try:
+            return r.evalsha(cls.script_shas[name], len(keys), *params)
+        except redis.exceptions.NoScriptError:
+            r.script_load(cls.scripts[name])
+            return r.evalsha(cls.script_shas[name], len(keys), *params)
+    
+    @classmethod
+    def _is_pattern(cls, key):
+        ''' Return whether a key contains glob-style wildcards '''
+        return '*' in key or '?' in key or '[' in key
 
     @classmethod
+    @instrumented("size")
     def size(cls, key=None):
         ''' Return the number of entries in cache 
         or the number of entries in a given key 
@@ -260,11 +1160,17 @@ class Cache:
                 return -1
 
     @classmethod
+    @instrumented("flush")
     def flush(cls):
         ''' Remove all cache entries '''
-        return cls.instance.redis.flushdb()
+        for f in (cls.key_filters or dict()).values():
+            f.clear()
+        res = cls.instance.redis.flushdb()
+        cls._invalidate((), ["*"])
+        return res
     
     @classmethod
+    @instrumented("remove_from")
     def remove_from(cls, key, value):
         ''' Remove a value from a cache entry (if applicable).
         Only works with hash or set.
@@ -277,78 +1183,162 @@ class Cache:
         
         if t == cls.REDIS_TYPE_SET:
             # Remove from a set
-            return r.srem(key, value)
+            res = r.srem(key, cls.codec.encode(value))
         elif t == cls.REDIS_TYPE_SORTED_SET:
             # Remove from a sorted set
-            return r.zrem(key, value)
+            res = r.zrem(key, value)
         elif t == cls.REDIS_TYPE_HASH:
             # Remove from a hash
-            return r.hdel(key, value)
+            res = r.hdel(key, value)
         else:
             raise ValueError("%s be a set or hash" % key)
+        
+        cls._invalidate([key])
+        return res
+    
+    @classmethod
+    def _set_op_key(cls, op, keys, weights=None, aggregate=None):
+        ''' Return the key storing the result of a set operation,
+        derived from a canonical digest of its inputs 
+        '''
+        inputs = sorted(zip(keys, weights or [1] * len(keys)))
+        digest = sha1(repr((op, inputs, (aggregate or "SUM").upper()))).hexdigest()
+        if isinstance(cls.instance.redis, ShardedRedis):
+            # Live on the same shard as the inputs
+            return "%s%s:{%s}%s" % (cls.SET_OP_PREFIX, op, hash_tag(keys[0]), digest)
+        return "%s%s:%s" % (cls.SET_OP_PREFIX, op, digest)
     
     @classmethod
-    def _get_rnd_key(cls, base=None):
-        ''' Generate a random key '''
-        return "%s%s" % (base if base else "", uuid.uuid4())
+    def _deps_key(cls, key):
+        ''' Return the key of the set of results depending on a given key '''
+        if isinstance(cls.instance.redis, ShardedRedis) and hash_tag(key) == key:
+            # Live on the same shard as the key
+            return "%s{%s}" % (cls.SET_OP_DEPS_PREFIX, key)
+        return cls.SET_OP_DEPS_PREFIX + key
     
     @classmethod
+    @instrumented("union")
     def union(cls, *keys, **kw):
         ''' Compute the union of two sets.
         Return the union set if not in-place, (res_key, res_card) otherwise.
-        Always in-place for sorted sets.
+        Always in-place for sorted sets. The result key is the same for the same
+        inputs, and is reused while they are unchanged if enabled (see enable_set_op_reuse).
+        inplace:    Whether to store the result
+        weights:    Score multipliers, one per key (sorted sets only)
+        aggregate:  How to combine scores: "SUM", "MIN" or "MAX" (sorted sets only)
         '''
-        in_place = kw.get('inplace', False)
-        r = cls.instance.redis
-        allowed_types = (cls.REDIS_TYPE_NONE, cls.REDIS_TYPE_SET, cls.REDIS_TYPE_SORTED_SET)
-        for key in keys:
-            if r.type(key) not in allowed_types:
-                raise ValueError("%s must be a set" % key)
-        
-        if r.type(keys[0]) == cls.REDIS_TYPE_SORTED_SET:
-            # Sorted sets
-            tmp_key = cls._get_rnd_key("union-")
-            n = r.zunionstore(tmp_key, keys)
-            r.expire(tmp_key, cls.KEY_DEFAULT_TTL)
-            return (tmp_key, n)
-        elif not in_place:
-            # Non-sorted sets
-            return r.sunion(*keys)
-        else:
-            # Stored non-sorted sets
-            tmp_key = cls._get_rnd_key("union-")
-            n = r.sunionstore(tmp_key, *keys)
-            r.expire(tmp_key, cls.KEY_DEFAULT_TTL)
-            return (tmp_key, n)
+        return cls._set_op("union", keys, kw.get('inplace', False), kw.get('weights'), kw.get('aggregate'))
             
     @classmethod
+    @instrumented("inter")
     def inter(cls, *keys, **kw):
         ''' Compute the intersection of two sets. 
         Return the union set if not in-place, (res_key, res_card) otherwise.
+        Same options as union.
+        '''
+        return cls._set_op("inter", keys, kw.get('inplace', False), kw.get('weights'), kw.get('aggregate'))
+    
+    @classmethod
+    @instrumented("union_card")
+    def union_card(cls, *keys):
+        ''' Return the size of the union of sets, without storing it '''
+        return cls._set_op_card("union", keys)
+    
+    @classmethod
+    @instrumented("inter_card")
+    def inter_card(cls, *keys):
+        ''' Return the size of the intersection of sets, without storing it '''
+        return cls._set_op_card("inter", keys)
+    
+    @classmethod
+    def _set_op(cls, op, keys, in_place, weights=None, aggregate=None):
+        ''' Compute the union or intersection of sets (see union) 
+        op:         "union" or "inter"
+        keys:       Keys of the sets
+        in_place:   Whether to store the result
+        weights:    Score multipliers (sorted sets only)
+        aggregate:  Score aggregation (sorted sets only)
         '''
-        in_place = kw.get('inplace', False)
         r = cls.instance.redis
+        if weights is not None and len(weights) != len(keys):
+            raise ValueError("Expected %s weights, got %s" % (len(keys), len(weights)))
+        reuse = cls.reuse_set_ops
+        res_key = cls._set_op_key(op, keys, weights, aggregate)
+        deps_keys = [cls._deps_key(k) for k in keys] if reuse else []
+        
+        if in_place and cls._use_scripts():
+            # Reuse or check types, store and expire in one round trip
+            args = [op.upper(), cls.KEY_DEFAULT_TTL, (aggregate or "SUM").upper(), int(reuse), len(keys)]
+            try:
+                n = cls._run_script("set_op_store", [res_key] + list(keys) + deps_keys, args + list(weights or []))
+            except redis.ResponseError, e:
+                if "must be a set" in str(e):
+                    raise ValueError(str(e))
+                raise
+            return (res_key, n)
+        
         allowed_types = (cls.REDIS_TYPE_NONE, cls.REDIS_TYPE_SET, cls.REDIS_TYPE_SORTED_SET)
+        pipe = r.pipeline(transaction=False)
         for key in keys:
-            t = r.type(key)
+            pipe.type(key)
+        pipe.type(res_key)
+        types = pipe.execute()
+        (types, res_type) = (types[:-1], types[-1])
+        for (key, t) in zip(keys, types):
             if t not in allowed_types:
                 raise ValueError("%s must be a set" % key)
         
-        if r.type(keys[0]) == cls.REDIS_TYPE_SORTED_SET:
-            # Sorted sets
-            tmp_key = cls._get_rnd_key("inter-")
-            n = r.zinterstore(tmp_key, keys)
-            r.expire(tmp_key, cls.KEY_DEFAULT_TTL)
-            return (tmp_key, n) 
-        elif not in_place:
+        stored = (in_place or types[0] == cls.REDIS_TYPE_SORTED_SET)
+        if stored and reuse and res_type == cls.REDIS_TYPE_SORTED_SET:
+            return (res_key, r.zcard(res_key))
+        elif stored and reuse and res_type == cls.REDIS_TYPE_SET:
+            return (res_key, r.scard(res_key))
+        elif not stored:
             # Non-sorted sets
-            return r.sinter(*keys)
+            return set(map(cls.codec.decode, getattr(r, "s" + op)(*keys)))
+        
+        pipe = r.pipeline(transaction=True)
+        if types[0] == cls.REDIS_TYPE_SORTED_SET:
+            # Sorted sets
+            getattr(pipe, "z%sstore" % op)(res_key, dict(zip(keys, weights)) if weights else keys, aggregate)
         else:
             # Stored non-sorted sets
-            tmp_key = cls._get_rnd_key("inter-")
-            n = r.sinterstore(tmp_key, *keys)
-            r.expire(tmp_key, cls.KEY_DEFAULT_TTL)
-            return (tmp_key, n)
+            getattr(pipe, "s%sstore" % op)(res_key, *keys)
+        pipe.expire(res_key, cls.KEY_DEFAULT_TTL)
+        for key in deps_keys:
+            pipe.sadd(key, res_key)
+            pipe.expire(key, cls.KEY_DEFAULT_TTL)
+        return (res_key, pipe.execute()[0])
+    
+    @classmethod
+    def _set_op_card(cls, op, keys):
+        ''' Return the size of the union or intersection of sets (see union_card) '''
+        r = cls.instance.redis
+        if cls._use_scripts():
+            try:
+                return cls._run_script("set_op_card", keys, [op.upper()])
+            except redis.ResponseError, e:
+                if "must be a set" in str(e):
+                    raise ValueError(str(e))
+                raise
+        
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        types = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for (key, t) in zip(keys, types):
+            if t == cls.REDIS_TYPE_SORTED_SET:
+                pipe.zrange(key, 0, -1)
+            elif t in (cls.REDIS_TYPE_SET, cls.REDIS_TYPE_NONE):
+                pipe.smembers(key)
+            else:
+                raise ValueError("%s must be a set" % key)
+        sets = [set(m) for m in pipe.execute()]
+        res = sets[0]
+        for members in sets[1:]:
+            res = res | members if op == "union" else res & members
+        return len(res)
 
     @classmethod
     def info(cls):
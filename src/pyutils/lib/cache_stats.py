@@ -0,0 +1,108 @@
+'''
+Created on Oct 18, 2026
+
+Usage statistics for Cache
+'''
+
+import threading
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+OTHER_NS = "other"
+
+class CacheStats:
+    ''' Counters and latency histograms for cache operations.
+
+    Counters are broken down by namespace, latencies by operation.
+    '''
+
+    def __init__(self, prefixes):
+        ''' Create a new set of stats
+        prefixes:   Map of namespaces to key prefixes
+        '''
+        self.prefixes = sorted(prefixes.items(), key=lambda x: -len(x[1]))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Reset all counters '''
+        with self.lock:
+            self.ops = dict()
+            self.namespaces = dict()
+
+    def namespace(self, key):
+        ''' Return the namespace of a key '''
+        for (ns, prefix) in self.prefixes:
+            if key.startswith(prefix):
+                return ns
+        return OTHER_NS
+
+    def _ns_counters(self, key):
+        ''' Return the counters of the namespace of a key (lock must be held) '''
+        ns = self.namespace(key) if key else OTHER_NS
+        counters = self.namespaces.get(ns)
+        if counters is None:
+            counters = self.namespaces[ns] = {'hits': 0, 'misses': 0, 'errors': 0,
+                                              'bytes_read': 0, 'bytes_written': 0}
+        return counters
+
+    def record(self, op, elapsed, key=None, error=False):
+        ''' Record a call to an operation
+        op:         Operation name
+        elapsed:    Duration in seconds
+        key:        Key the operation was called on, if any
+        error:      Whether the operation failed
+        '''
+        ms = elapsed * 1000
+        i = 0
+        while i < len(LATENCY_BUCKETS) and ms > LATENCY_BUCKETS[i]:
+            i += 1
+        with self.lock:
+            stats = self.ops.get(op)
+            if stats is None:
+                stats = self.ops[op] = {'count': 0, 'errors': 0, 'total_ms': 0.0,
+                                        'max_ms': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += ms
+            stats['histogram'][i] += 1
+            if ms > stats['max_ms']:
+                stats['max_ms'] = ms
+            if error:
+                stats['errors'] += 1
+                self._ns_counters(key)['errors'] += 1
+
+    def lookup(self, key, hit):
+        ''' Record a cache hit or miss '''
+        with self.lock:
+            self._ns_counters(key)['hits' if hit else 'misses'] += 1
+
+    def read(self, key, nbytes):
+        ''' Record bytes read from a key '''
+        with self.lock:
+            self._ns_counters(key)['bytes_read'] += nbytes
+
+    def written(self, key, nbytes):
+        ''' Record bytes written to a key '''
+        with self.lock:
+            self._ns_counters(key)['bytes_written'] += nbytes
+
+    def snapshot(self):
+        ''' Return a copy of all stats:
+         - ops: count, errors, total_ms, max_ms and latency histogram for each operation
+                (histogram buckets are labelled by their upper bound in ms)
+         - namespaces: hits, misses, errors, bytes read and written, hit rate for each namespace
+        '''
+        labels = ["%s" % b for b in LATENCY_BUCKETS] + ["inf"]
+        with self.lock:
+            ops = dict()
+            for op in self.ops:
+                stats = dict(self.ops[op])
+                stats['histogram'] = dict(zip(labels, stats['histogram']))
+                ops[op] = stats
+            namespaces = dict()
+            for ns in self.namespaces:
+                counters = dict(self.namespaces[ns])
+                lookups = counters['hits'] + counters['misses']
+                counters['hit_rate'] = float(counters['hits']) / lookups if lookups else None
+                namespaces[ns] = counters
+        return {'ops': ops, 'namespaces': namespaces}
@@ -0,0 +1,262 @@
+'''
+Created on Oct 18, 2026
+
+Value codecs used to store Python values in cache.
+
+Tagged values start with MAGIC followed by a one character type tag,
+so any registered codec can read values written by any other one.
+Untagged values are read with the legacy reader, which parses
+Python literals without ever calling eval().
+
+Large values can be compressed by wrapping any codec in a CompressedCodec.
+
+@requires: msgpack (pip install msgpack-python) for MsgpackCodec only
+@requires: lz4 (pip install lz4) for lz4 compression only
+'''
+
+from ast import literal_eval
+import marshal
+import json
+import zlib
+import re
+
+MAGIC = "\x00"
+TAG_STR = "s"
+TAG_UNICODE = "u"
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+# First characters a Python literal can start with
+LITERAL_START = frozenset("0123456789-+.'\"[{(TFNuUrRbBs \t")
+NUMBER_PATTERN = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?\Z")
+
+_codecs = dict()
+
+
+def register(codec):
+    ''' Register a tagged codec for reading '''
+    if codec.tag in _codecs and type(_codecs[codec.tag]) != type(codec):
+        raise ValueError("Codec tag %s already in use" % codec.tag)
+    _codecs[codec.tag] = codec
+    return codec
+
+def decode(s):
+    ''' Decode a value written by any registered codec
+    or in the legacy format
+    '''
+    if s and s[0] == MAGIC and len(s) > 1:
+        tag = s[1]
+        if tag == TAG_STR:
+            return s[2:]
+        elif tag == TAG_UNICODE:
+            return s[2:].decode('utf-8')
+        codec = _codecs.get(tag)
+        if codec:
+            try:
+                return codec.loads(s[2:])
+            except Exception:
+                # Legacy raw string that happens to look tagged
+                pass
+    return legacy_decode(s)
+
+def legacy_decode(s):
+    ''' Read a value stored as its string representation.
+    Return the string itself if it is not a Python literal.
+    '''
+    if not s or s[0] not in LITERAL_START:
+        return s
+    m = NUMBER_PATTERN.match(s)
+    if m:
+        # Plain numbers are by far the most common literals
+        return float(s) if m.group(2) else int(s)
+    try:
+        if s.startswith("set([") and s.endswith("])"):
+            return set(literal_eval(s[4:-1]))
+        return literal_eval(s)
+    except (ValueError, SyntaxError, TypeError, MemoryError):
+        return s
+
+
+class Codec:
+    ''' Base value codec '''
+
+    tag = None
+
+    def encode(self, v):
+        ''' Encode a value for storage '''
+        raise NotImplementedError()
+
+    def decode(self, s):
+        ''' Decode a stored value '''
+        return decode(s)
+
+
+class ReprCodec(Codec):
+    ''' Legacy codec. Values are stored as their string
+    representation and read back as Python literals.
+    '''
+
+    def encode(self, v):
+        ''' Let the client convert the value to a string,
+        tagging strings that would be read as tagged values
+        '''
+        t = type(v)
+        if t == str and v.startswith(MAGIC):
+            return MAGIC + TAG_STR + v
+        elif t == unicode and v.startswith(MAGIC):
+            return MAGIC + TAG_UNICODE + v.encode('utf-8')
+        return v
+
+
+class TaggedCodec(Codec):
+    ''' Base for codecs that prefix values with a type tag.
+    Byte and unicode strings are stored as is, any other
+    value goes through dumps/loads.
+    '''
+
+    def __init__(self):
+        self.prefix = MAGIC + self.tag
+        register(self)
+
+    def encode(self, v):
+        ''' Encode a value with its type tag '''
+        t = type(v)
+        if t == str:
+            return MAGIC + TAG_STR + v
+        elif t == unicode:
+            return MAGIC + TAG_UNICODE + v.encode('utf-8')
+        return self.prefix + self.dumps(v)
+
+    def dumps(self, v):
+        ''' Serialize a non-string value '''
+        raise NotImplementedError()
+
+    def loads(self, s):
+        ''' Deserialize a non-string value '''
+        raise NotImplementedError()
+
+
+class MarshalCodec(TaggedCodec):
+    ''' Fastest codec, round-trips any built-in type exactly '''
+
+    tag = "m"
+
+    def dumps(self, v):
+        return marshal.dumps(v)
+
+    def loads(self, s):
+        return marshal.loads(s)
+
+
+class JsonCodec(TaggedCodec):
+    ''' Portable codec. Tuples and sets come back as lists
+    and nested strings as unicode.
+    '''
+
+    tag = "j"
+
+    def dumps(self, v):
+        if type(v) == set:
+            v = list(v)
+        return json.dumps(v, separators=(',', ':'))
+
+    def loads(self, s):
+        return json.loads(s)
+
+
+class MsgpackCodec(TaggedCodec):
+    ''' Compact portable codec. Tuples and sets come back as lists. '''
+
+    tag = "p"
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+        TaggedCodec.__init__(self)
+
+    def dumps(self, v):
+        if type(v) == set:
+            v = list(v)
+        return self.msgpack.packb(v)
+
+    def loads(self, s):
+        return self.msgpack.unpackb(s)
+
+
+class Compression:
+    ''' Compression algorithm usable by CompressedCodec '''
+
+    def __init__(self, tag, compress, decompress):
+        ''' Create a new algorithm
+        tag:            Type tag of compressed values
+        compress:       Function taking a string and a compression level
+        decompress:     Function taking a compressed string
+        '''
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+
+    def loads(self, s):
+        ''' Decompress then decode a value '''
+        return decode(self.decompress(s))
+
+
+class CompressedCodec(Codec):
+    ''' Wraps another codec and compresses the values it 
+    encodes when they are large enough to be worth it
+    '''
+
+    def __init__(self, codec, threshold=DEFAULT_COMPRESS_THRESHOLD, level=1, algorithm="zlib"):
+        ''' Create a new codec
+        codec:      Codec encoding values before compression
+        threshold:  Minimum size in bytes of a value to compress it
+        level:      Compression level (zlib only)
+        algorithm:  "zlib" or "lz4"
+        '''
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.compression = compressions[algorithm]
+        self.prefix = MAGIC + self.compression.tag
+        self.count = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def encode(self, v):
+        ''' Encode a value, compressed if large enough '''
+        s = self.codec.encode(v)
+        t = type(s)
+        if t == unicode:
+            s = s.encode('utf-8')
+        elif t == float:
+            s = repr(s)
+        elif t != str:
+            s = str(s)
+        if len(s) < self.threshold:
+            return s
+        c = self.compression.compress(s, self.level)
+        if len(c) + 2 >= len(s):
+            # Not compressible
+            return s
+        self.count += 1
+        self.raw_bytes += len(s)
+        self.compressed_bytes += len(c) + 2
+        return self.prefix + c
+
+    def stats(self):
+        ''' Return compression stats '''
+        return {'compressed': self.count,
+                'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'ratio': float(self.compressed_bytes) / self.raw_bytes if self.raw_bytes else 1.0}
+
+
+compressions = {"zlib": register(Compression("z", zlib.compress, zlib.decompress))}
+try:
+    import lz4.block
+    compressions["lz4"] = register(Compression("l", lambda s, level: lz4.block.compress(s), lz4.block.decompress))
+except ImportError:
+    pass
+
+# Built-in codecs can always be read
+register(MarshalCodec())
+register(JsonCodec())
@@ -0,0 +1,183 @@
+'''
+Created on Oct 18, 2026
+
+In-process cache tier used in front of Redis by Cache
+'''
+
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 60
+DEFAULT_CHANNEL = "pyutils-cache-invalidate"
+RETRY_DELAY = 1.0
+VERSION_SLOTS = 1024
+# Prefixes of invalidation messages
+KEY_MESSAGE = "k"
+PATTERN_MESSAGE = "p"
+
+class LocalCache:
+    ''' Bounded LRU cache with per-entry expiration.
+
+    Invalidations can be broadcast to other processes
+    through a Redis pub/sub channel.
+
+    Each invalidation bumps the version of the key (or of all keys for
+    patterns), so that a value read before it is not cached after it.
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=None, ttl=DEFAULT_TTL, prefixes=None):
+        ''' Create a new local cache
+        max_entries:    Maximum number of entries
+        max_bytes:      Maximum total size of the entries (None = Unbounded)
+        ttl:            Maximum time to live of an entry in seconds
+        prefixes:       Only cache keys starting with one of these (None = All)
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefixes = tuple(prefixes) if prefixes else None
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        # Per key versions, in hashed slots to bound memory
+        self.versions = [0] * VERSION_SLOTS
+        self.epoch = 0
+        self.redis = None
+        self.channel = None
+        self.pubsub = None
+        self.on = False
+
+    def accepts(self, key):
+        ''' Return whether a key can be cached locally '''
+        return self.prefixes is None or key.startswith(self.prefixes)
+
+    def get(self, key):
+        ''' Return a cached value, None if not found or expired '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                self.nbytes -= entry[2]
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def version(self, key):
+        ''' Return the current version of a key, to be passed to set '''
+        return (self.epoch, self.versions[hash(key) % VERSION_SLOTS])
+
+    def set(self, key, value, size=0, ttl=None, version=None):
+        ''' Cache a value locally
+        key:        Cache key
+        value:      Value
+        size:       Approximate size of the value in bytes
+        ttl:        Time to live in seconds, capped by the cache ttl
+        version:    Version of the key when the value was read, the value
+                    is not cached if the key was invalidated since
+        '''
+        if self.max_bytes and size > self.max_bytes:
+            return
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+        with self.lock:
+            if version is not None and version != self.version(key):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[key] = (value, time.time() + ttl, size)
+            self.nbytes += size
+            # Evict least recently used entries
+            while len(self.entries) > self.max_entries or (self.max_bytes and self.nbytes > self.max_bytes):
+                self.nbytes -= self.entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        ''' Drop a key, taken as is even if it contains wildcards '''
+        with self.lock:
+            self._delete(key)
+
+    def delete_matching(self, pattern):
+        ''' Drop all keys matching a glob-style pattern 
+        (as well as the key equal to the pattern itself, which may not match it)
+        '''
+        with self.lock:
+            self._delete(pattern)
+            self.epoch += 1
+            for key in [k for k in self.entries if fnmatchcase(k, pattern)]:
+                self.nbytes -= self.entries.pop(key)[2]
+
+    def _delete(self, key):
+        ''' Drop a key and bump its version, the lock being held '''
+        self.versions[hash(key) % VERSION_SLOTS] += 1
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[2]
+
+    def clear(self):
+        ''' Drop all entries '''
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.nbytes = 0
+
+    def size(self):
+        ''' Return the number of entries '''
+        return len(self.entries)
+
+    def invalidate(self, keys, patterns=()):
+        ''' Drop keys and patterns here and in any other subscribed process 
+        keys:       Keys, taken as is even if they contain wildcards
+        patterns:   Glob-style patterns (see delete_matching)
+        '''
+        for key in keys:
+            self.delete(key)
+        for pattern in patterns:
+            self.delete_matching(pattern)
+        if self.on:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.publish(self.channel, KEY_MESSAGE + key)
+            for pattern in patterns:
+                pipe.publish(self.channel, PATTERN_MESSAGE + pattern)
+            pipe.execute()
+
+    def subscribe(self, redis_client, channel=DEFAULT_CHANNEL):
+        ''' Start listening for invalidations from other processes
+        redis_client:   Redis client used for pub/sub
+        channel:        Invalidation channel
+        '''
+        self.redis = redis_client
+        self.channel = channel
+        self.on = True
+        listener = threading.Thread(target=self._listen, name="cache-invalidation")
+        listener.daemon = True
+        listener.start()
+
+    def close(self):
+        ''' Stop listening for invalidations '''
+        self.on = False
+        if self.pubsub is not None:
+            self.pubsub.unsubscribe()
+
+    def _listen(self):
+        ''' Invalidation loop, reconnects on error '''
+        while self.on:
+            try:
+                self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(self.channel)
+                # Entries may have gone stale while disconnected
+                self.clear()
+                for msg in self.pubsub.listen():
+                    if msg and msg['type'] == 'message':
+                        data = msg['data']
+                        if data.startswith(PATTERN_MESSAGE):
+                            self.delete_matching(data[1:])
+                        else:
+                            self.delete(data[1:])
+            except Exception:
+                if self.on:
+                    time.sleep(RETRY_DELAY)
@@ -0,0 +1,178 @@
+'''
+Created on Oct 18, 2026
+
+Memoization of function results in Cache, with stampede protection:
+ - Only one caller at a time recomputes an expired value (single flight)
+ - Stale values can be served while the recomputation runs in the background
+ - Values are recomputed slightly before they expire, at random,
+   so that hot keys do not all expire at once (probabilistic early expiration)
+
+@requires: redis (pip install redis)
+'''
+
+from pyutils.lib.cache import Cache
+from pyutils.lib.codec import MarshalCodec
+from math import log
+import threading
+import inspect
+import random
+import redis
+import time
+import uuid
+
+DEFAULT_BETA = 1.0
+DEFAULT_LOCK_TTL = 10
+POLL_INTERVAL = 0.05
+
+FIELD_VALUE = "v"
+FIELD_DELTA = "d"
+FIELD_EXPIRY = "x"
+
+# Results keep their exact type whatever the Cache codec
+_codec = MarshalCodec()
+
+
+def cached(ns, ttl=Cache.KEY_DEFAULT_TTL, stale_ttl=0, beta=DEFAULT_BETA, lock_ttl=DEFAULT_LOCK_TTL, key_func=None):
+    ''' Decorator caching the result of a function under a namespaced key
+    ns:         Cache namespace (see Cache.NS_PREFIXES)
+    ttl:        Time in seconds a result stays fresh
+    stale_ttl:  Time in seconds an expired result can still be served
+                while it is recomputed in the background (0 = Never)
+    beta:       Early expiration factor, higher values recompute earlier (0 = Disabled)
+    lock_ttl:   Maximum time in seconds a caller can hold the recomputation lock
+    key_func:   Function building the key from the call arguments
+                (default: Cache.make_ns_key with the module, function name and arguments)
+    
+    Results are stored with marshal, so they must be built-in types.
+    '''
+
+    def decorator(f):
+
+        arg_names = inspect.getargspec(f).args
+        skip_first = len(arg_names) > 0 and arg_names[0] in ("self", "cls")
+
+        def make_key(*args, **kw):
+            ''' Build the cache key of a call '''
+            if key_func:
+                return key_func(*args, **kw)
+            params = inspect.getcallargs(f, *args, **kw)
+            if skip_first:
+                params.pop(arg_names[0])
+            return Cache.make_ns_key(ns, f.__module__, f.__name__, params, strict=True)
+
+        def compute(key, *args, **kw):
+            ''' Call the function and cache its result '''
+            start = time.time()
+            v = f(*args, **kw)
+            now = time.time()
+            entry = {FIELD_VALUE: _codec.encode(v), FIELD_DELTA: now - start, FIELD_EXPIRY: now + ttl}
+            Cache.put(key, entry, ttl + stale_ttl, atomic=True)
+            return v
+
+        def refresh(key, token, *args, **kw):
+            ''' Recompute a value, then release the lock '''
+            try:
+                compute(key, *args, **kw)
+            except Exception:
+                # Keep serving the stale value until it expires
+                pass
+            finally:
+                _release(key, token)
+
+        def wrapper(*args, **kw):
+            key = make_key(*args, **kw)
+            entry = Cache.get(key)
+
+            if entry and FIELD_VALUE in entry:
+                v = _value(entry)
+                if not _should_recompute(entry, beta):
+                    return v
+                token = _acquire(key, lock_ttl)
+                if token is None:
+                    # Someone else is recomputing it
+                    return v
+                if stale_ttl:
+                    t = threading.Thread(target=refresh, args=(key, token) + args, kwargs=kw)
+                    t.daemon = True
+                    t.start()
+                    return v
+                try:
+                    return compute(key, *args, **kw)
+                finally:
+                    _release(key, token)
+
+            # Not cached yet
+            token = _acquire(key, lock_ttl)
+            if token is None:
+                entry = _wait_for(key, lock_ttl)
+                if entry:
+                    return _value(entry)
+                # Lock holder did not deliver, compute it ourselves
+                return compute(key, *args, **kw)
+            try:
+                return compute(key, *args, **kw)
+            finally:
+                _release(key, token)
+
+        def invalidate(*args, **kw):
+            ''' Drop the cached result of a call '''
+            Cache.remove(make_key(*args, **kw), False, exact=True)
+
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        wrapper.make_key = make_key
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
+
+
+def _value(entry):
+    ''' Return the result held by a cached entry '''
+    v = entry[FIELD_VALUE]
+    return _codec.decode(v) if isinstance(v, basestring) else v
+
+def _should_recompute(entry, beta):
+    ''' Return whether a cached entry has expired, or should be
+    recomputed early given how long it took to compute
+    '''
+    expiry = float(entry.get(FIELD_EXPIRY, 0))
+    delta = float(entry.get(FIELD_DELTA, 0))
+    return time.time() - delta * beta * log(1.0 - random.random()) >= expiry
+
+def _lock_key(key):
+    ''' Return the key of the lock guarding a cached value '''
+    return "%s:lock" % key
+
+def _acquire(key, ttl):
+    ''' Try to take the lock for a key, return its token or None '''
+    token = str(uuid.uuid4())
+    if Cache.instance.redis.set(_lock_key(key), token, px=int(ttl * 1000), nx=True):
+        return token
+    return None
+
+def _release(key, token):
+    ''' Release a lock, only if it is still held with the given token '''
+    lock_key = _lock_key(key)
+    def release(pipe):
+        if pipe.get(lock_key) == token:
+            pipe.multi()
+            pipe.delete(lock_key)
+    try:
+        Cache.instance.redis.transaction(release, lock_key)
+    except redis.RedisError:
+        # The lock expires on its own anyway
+        pass
+
+def _wait_for(key, timeout):
+    ''' Wait for another caller to cache a value, return its entry or None '''
+    r = Cache.instance.redis
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = Cache.get(key)
+        if entry and FIELD_VALUE in entry:
+            return entry
+        if not r.exists(_lock_key(key)):
+            break
+    return None
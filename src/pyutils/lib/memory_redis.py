@@ -0,0 +1,606 @@
+'''
+Created on Oct 18, 2026
+
+In-process stand-in for a Redis server.
+
+MemoryRedis implements the subset of the StrictRedis client API that
+Cache relies on (strings, hashes, lists, sets, sorted sets, expiration,
+scans, pipelines, transactions and pub/sub), so Cache can run and be
+benchmarked without a server:
+
+    Cache.init(client=MemoryRedis())
+
+Scripting is not supported: script commands fail with the same error
+as a server without Lua, so Cache falls back to plain commands.
+
+@requires: redis (pip install redis)
+'''
+
+from fnmatch import fnmatchcase
+from Queue import Queue, Empty
+import threading
+import redis
+import time
+
+WRONG_TYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+TYPE_NONE = "none"
+TYPE_STR = "string"
+TYPE_HASH = "hash"
+TYPE_LIST = "list"
+TYPE_SET = "set"
+TYPE_SORTED_SET = "zset"
+
+
+def _enc(v):
+    ''' Convert a value to a string the way the Redis client does '''
+    if isinstance(v, str):
+        return v
+    if isinstance(v, float):
+        return repr(v)
+    if not isinstance(v, basestring):
+        v = unicode(v)
+    return v.encode("utf-8")
+
+def _match(key, pattern):
+    ''' Return whether a key matches a Redis glob-style pattern '''
+    return pattern is None or fnmatchcase(key, pattern.replace("[^", "[!"))
+
+def _keys(keys, args):
+    ''' Merge a key or list of keys with extra key arguments '''
+    keys = [keys] if isinstance(keys, basestring) else list(keys)
+    return keys + list(args)
+
+def _range(items, start, end):
+    ''' Slice a sequence with inclusive, possibly negative Redis indexes '''
+    n = len(items)
+    start = max(n + start, 0) if start < 0 else start
+    end = n + end if end < 0 else min(end, n - 1)
+    if start > end:
+        return list()
+    return items[start:end + 1]
+
+def _score_bound(v):
+    ''' Parse a sorted set score bound, return (score, exclusive) '''
+    if isinstance(v, basestring):
+        if v.startswith("("):
+            return (float(v[1:]), True)
+        if v in ("-inf", "+inf", "inf"):
+            return (float(v), False)
+    return (float(v), False)
+
+
+class MemoryRedis:
+    ''' Thread-safe, in-memory implementation of the Redis commands used by Cache.
+
+    Each command runs under a single lock, and so do pipelines and
+    transactions as a whole, which makes them atomic. Expired keys are
+    dropped lazily, on access.
+    '''
+
+    def __init__(self):
+        self.data = dict()
+        self.expires = dict()
+        self.channels = dict()
+        self.lock = threading.RLock()
+
+    # Key space
+
+    def _live(self, key):
+        ''' Return whether a key exists, dropping it if expired '''
+        expiry = self.expires.get(key)
+        if expiry is not None and expiry <= time.time():
+            del self.expires[key]
+            del self.data[key]
+            return False
+        return key in self.data
+
+    def _get(self, key, t, create=False):
+        ''' Return the value of a key of a given type.
+        Return None if not found, unless create is set.
+        Raise a ResponseError if the key holds another type.
+        '''
+        if not self._live(key):
+            if not create:
+                return None
+            self.data[key] = (t, {TYPE_HASH: dict, TYPE_LIST: list, TYPE_SET: set,
+                                  TYPE_SORTED_SET: dict}[t]())
+        (kt, v) = self.data[key]
+        if kt != t:
+            raise redis.ResponseError(WRONG_TYPE)
+        return v
+
+    def _drop_if_empty(self, key):
+        ''' Delete a container key left empty, as Redis does '''
+        if key in self.data and not self.data[key][1]:
+            self._drop(key)
+
+    def _drop(self, key):
+        ''' Delete a key '''
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    def type(self, name):
+        with self.lock:
+            return self.data[name][0] if self._live(name) else TYPE_NONE
+
+    def exists(self, name):
+        with self.lock:
+            return self._live(name)
+
+    def delete(self, *names):
+        with self.lock:
+            n = 0
+            for name in names:
+                if self._live(name):
+                    self._drop(name)
+                    n += 1
+            return n
+
+    def expire(self, name, time_s):
+        return self.pexpire(name, int(time_s * 1000))
+
+    def pexpire(self, name, time_ms):
+        with self.lock:
+            if not self._live(name):
+                return False
+            self.expires[name] = time.time() + time_ms / 1000.0
+            return True
+
+    def persist(self, name):
+        with self.lock:
+            return self._live(name) and self.expires.pop(name, None) is not None
+
+    def pttl(self, name):
+        with self.lock:
+            if not self._live(name):
+                return -2
+            if name not in self.expires:
+                return -1
+            return max(int(round((self.expires[name] - time.time()) * 1000)), 0)
+
+    def ttl(self, name):
+        ms = self.pttl(name)
+        return ms if ms < 0 else int(round(ms / 1000.0))
+
+    def scan_iter(self, match=None, count=None):
+        ''' Iterate over a snapshot of the keys.
+        Keys deleted during the scan are skipped, keys added may be missed.
+        '''
+        with self.lock:
+            keys = self.data.keys()
+        for key in keys:
+            if _match(key, match):
+                with self.lock:
+                    live = self._live(key)
+                if live:
+                    yield key
+
+    def keys(self, pattern="*"):
+        with self.lock:
+            return [k for k in self.data.keys() if self._live(k) and _match(k, pattern)]
+
+    def dbsize(self):
+        with self.lock:
+            return len(self.keys())
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+            return True
+
+    flushall = flushdb
+
+    def info(self, section=None):
+        with self.lock:
+            return {'redis_mode': "memory", 'keys': self.dbsize(), 'expires': len(self.expires)}
+
+    def ping(self):
+        return True
+
+    def execute_command(self, *args, **options):
+        ''' Run a raw command, only key deletion is supported '''
+        if args[0].upper() in ("UNLINK", "DEL"):
+            return self.delete(*args[1:])
+        raise redis.ResponseError("unknown command '%s'" % args[0])
+
+    # Strings
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name, TYPE_STR)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.lock:
+            exists = self._live(name)
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._drop(name)
+            self.data[name] = (TYPE_STR, _enc(value))
+            if ex or px:
+                self.pexpire(name, px or ex * 1000)
+            return True
+
+    def mget(self, keys, *args):
+        with self.lock:
+            return [self.data[k][1] if self._live(k) and self.data[k][0] == TYPE_STR else None
+                    for k in _keys(keys, args)]
+
+    def setbit(self, name, offset, value):
+        with self.lock:
+            bits = bytearray(self._get(name, TYPE_STR) or "")
+            if len(bits) <= offset >> 3:
+                bits.extend(bytearray((offset >> 3) + 1 - len(bits)))
+            mask = 0x80 >> (offset & 7)
+            old = 1 if bits[offset >> 3] & mask else 0
+            bits[offset >> 3] = (bits[offset >> 3] | mask) if value else (bits[offset >> 3] & ~mask)
+            self.data[name] = (TYPE_STR, str(bits))
+            return old
+
+    def getbit(self, name, offset):
+        with self.lock:
+            bits = bytearray(self._get(name, TYPE_STR) or "")
+            if len(bits) <= offset >> 3:
+                return 0
+            return 1 if bits[offset >> 3] & (0x80 >> (offset & 7)) else 0
+
+    # Hashes
+
+    def hmset(self, name, mapping):
+        with self.lock:
+            h = self._get(name, TYPE_HASH, True)
+            for k in mapping:
+                h[_enc(k)] = _enc(mapping[k])
+            return True
+
+    def hset(self, name, key, value):
+        with self.lock:
+            h = self._get(name, TYPE_HASH, True)
+            key = _enc(key)
+            n = 0 if key in h else 1
+            h[key] = _enc(value)
+            return n
+
+    def hget(self, name, key):
+        with self.lock:
+            return (self._get(name, TYPE_HASH) or dict()).get(_enc(key))
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name, TYPE_HASH) or dict())
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            h = self._get(name, TYPE_HASH) or dict()
+            n = len([h.pop(_enc(k)) for k in keys if _enc(k) in h])
+            self._drop_if_empty(name)
+            return n
+
+    def hlen(self, name):
+        with self.lock:
+            return len(self._get(name, TYPE_HASH) or dict())
+
+    def hscan_iter(self, name, match=None, count=None):
+        with self.lock:
+            items = (self._get(name, TYPE_HASH) or dict()).items()
+        for (k, v) in items:
+            if _match(k, match):
+                yield (k, v)
+
+    # Lists
+
+    def rpush(self, name, *values):
+        with self.lock:
+            l = self._get(name, TYPE_LIST, True)
+            l.extend(_enc(v) for v in values)
+            return len(l)
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            return _range(self._get(name, TYPE_LIST) or list(), int(start), int(end))
+
+    def lindex(self, name, index):
+        with self.lock:
+            l = self._get(name, TYPE_LIST) or list()
+            return l[index] if -len(l) <= index < len(l) else None
+
+    def llen(self, name):
+        with self.lock:
+            return len(self._get(name, TYPE_LIST) or list())
+
+    # Sets
+
+    def sadd(self, name, *values):
+        with self.lock:
+            s = self._get(name, TYPE_SET, True)
+            n = len(s)
+            s.update(_enc(v) for v in values)
+            return len(s) - n
+
+    def srem(self, name, *values):
+        with self.lock:
+            s = self._get(name, TYPE_SET) or set()
+            n = len(s)
+            s.difference_update(_enc(v) for v in values)
+            n -= len(s)
+            self._drop_if_empty(name)
+            return n
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self._get(name, TYPE_SET) or set())
+
+    def sismember(self, name, value):
+        with self.lock:
+            return _enc(value) in (self._get(name, TYPE_SET) or set())
+
+    def scard(self, name):
+        with self.lock:
+            return len(self._get(name, TYPE_SET) or set())
+
+    def sscan_iter(self, name, match=None, count=None):
+        with self.lock:
+            members = list(self._get(name, TYPE_SET) or set())
+        for m in members:
+            if _match(m, match):
+                yield m
+
+    def _set_op(self, op, keys):
+        ''' Union or intersection of several sets '''
+        sets = [self._get(k, TYPE_SET) or set() for k in keys]
+        res = set(sets[0])
+        for s in sets[1:]:
+            res = res | s if op == "union" else res & s
+        return res
+
+    def _set_op_store(self, op, dest, keys):
+        ''' Store the union or intersection of several sets '''
+        res = self._set_op(op, keys)
+        self._drop(dest)
+        if res:
+            self.data[dest] = (TYPE_SET, res)
+        return len(res)
+
+    def sunion(self, keys, *args):
+        with self.lock:
+            return self._set_op("union", _keys(keys, args))
+
+    def sinter(self, keys, *args):
+        with self.lock:
+            return self._set_op("inter", _keys(keys, args))
+
+    def sunionstore(self, dest, keys, *args):
+        with self.lock:
+            return self._set_op_store("union", dest, _keys(keys, args))
+
+    def sinterstore(self, dest, keys, *args):
+        with self.lock:
+            return self._set_op_store("inter", dest, _keys(keys, args))
+
+    # Sorted sets
+
+    def zadd(self, name, *args, **kwargs):
+        ''' Add members: zadd(name, score1, member1, ..., member=score, ...) '''
+        if len(args) % 2:
+            raise redis.RedisError("ZADD requires an equal number of values and scores")
+        pairs = [(args[i + 1], args[i]) for i in range(0, len(args), 2)] + kwargs.items()
+        with self.lock:
+            z = self._get(name, TYPE_SORTED_SET, True)
+            n = len(z)
+            for (member, score) in pairs:
+                z[_enc(member)] = float(score)
+            return len(z) - n
+
+    def zrem(self, name, *values):
+        with self.lock:
+            z = self._get(name, TYPE_SORTED_SET) or dict()
+            n = len([z.pop(_enc(v)) for v in values if _enc(v) in z])
+            self._drop_if_empty(name)
+            return n
+
+    def zcard(self, name):
+        with self.lock:
+            return len(self._get(name, TYPE_SORTED_SET) or dict())
+
+    def zscore(self, name, value):
+        with self.lock:
+            return (self._get(name, TYPE_SORTED_SET) or dict()).get(_enc(value))
+
+    def _zsorted(self, name, desc=False):
+        ''' Return the (member, score) pairs of a sorted set in order '''
+        z = self._get(name, TYPE_SORTED_SET) or dict()
+        return sorted(z.items(), key=lambda x: (x[1], x[0]), reverse=desc)
+
+    def _zresult(self, items, withscores, score_cast_func):
+        if withscores:
+            return [(m, score_cast_func(repr(s))) for (m, s) in items]
+        return [m for (m, _) in items]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self.lock:
+            items = _range(self._zsorted(name, desc), int(start), int(end))
+            return self._zresult(items, withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        (lo, lo_ex) = _score_bound(min)
+        (hi, hi_ex) = _score_bound(max)
+        with self.lock:
+            items = [(m, s) for (m, s) in self._zsorted(name)
+                     if (s > lo if lo_ex else s >= lo) and (s < hi if hi_ex else s <= hi)]
+        if start is not None and num is not None:
+            items = items[start:start + num] if num >= 0 else items[start:]
+        return self._zresult(items, withscores, score_cast_func)
+
+    def zscan_iter(self, name, match=None, count=None, score_cast_func=float):
+        with self.lock:
+            items = self._zsorted(name)
+        for (m, s) in items:
+            if _match(m, match):
+                yield (m, score_cast_func(repr(s)))
+
+    def _zset_op_store(self, op, dest, keys, aggregate):
+        ''' Store the union or intersection of sets and sorted sets '''
+        weights = keys if isinstance(keys, dict) else dict()
+        agg = {None: sum, "SUM": sum, "MIN": min, "MAX": max}[aggregate and aggregate.upper()]
+        scores = list()
+        for key in keys:
+            if self._live(key) and self.data[key][0] == TYPE_SET:
+                z = dict((m, 1.0) for m in self.data[key][1])
+            else:
+                z = self._get(key, TYPE_SORTED_SET) or dict()
+            w = float(weights.get(key, 1))
+            scores.append(dict((m, z[m] * w) for m in z))
+        members = set(scores[0])
+        for z in scores[1:]:
+            members = members | set(z) if op == "union" else members & set(z)
+        res = dict((m, agg([z[m] for z in scores if m in z])) for m in members)
+        self._drop(dest)
+        if res:
+            self.data[dest] = (TYPE_SORTED_SET, res)
+        return len(res)
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        with self.lock:
+            return self._zset_op_store("union", dest, keys, aggregate)
+
+    def zinterstore(self, dest, keys, aggregate=None):
+        with self.lock:
+            return self._zset_op_store("inter", dest, keys, aggregate)
+
+    # Scripting (not supported)
+
+    def _no_scripting(self, *args, **kw):
+        raise redis.ResponseError("unknown command 'EVALSHA'")
+
+    eval = evalsha = script_load = script_exists = _no_scripting
+
+    # Pipelines and transactions
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self, transaction)
+
+    def transaction(self, func, *watches, **kw):
+        ''' Run func(pipe) then execute the pipe, all under the lock.
+        Watched keys cannot change meanwhile, so there are no retries.
+        '''
+        with self.lock:
+            pipe = self.pipeline(True)
+            pipe.watch(*watches)
+            res = func(pipe)
+            exec_res = pipe.execute()
+            return res if kw.get('value_from_callable', False) else exec_res
+
+    # Pub/sub
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, list()))
+        msg = {'type': "message", 'pattern': None, 'channel': channel, 'data': _enc(message)}
+        for ps in subscribers:
+            ps.queue.put(msg)
+        return len(subscribers)
+
+    def pubsub(self, **kw):
+        return MemoryPubSub(self, kw.get('ignore_subscribe_messages', False))
+
+
+class MemoryPipeline:
+    ''' Pipeline over a MemoryRedis client.
+    Commands are run immediately while watching (as with Redis),
+    queued after multi() or if never watching.
+    '''
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.commands = list()
+        self.watching = False
+
+    def watch(self, *names):
+        self.watching = True
+
+    def multi(self):
+        self.watching = False
+
+    def __getattr__(self, name):
+        ''' Run or queue any client command '''
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+        def command(*args, **kw):
+            if self.watching:
+                return method(*args, **kw)
+            self.commands.append((method, args, kw))
+            return self
+        return command
+
+    def execute(self, raise_on_error=True):
+        ''' Run all queued commands atomically, return their results in order '''
+        res = list()
+        with self.client.lock:
+            for (method, args, kw) in self.commands:
+                try:
+                    res.append(method(*args, **kw))
+                except redis.ResponseError, e:
+                    res.append(e)
+        self.reset()
+        if raise_on_error:
+            for r in res:
+                if isinstance(r, redis.ResponseError):
+                    raise r
+        return res
+
+    def reset(self):
+        self.commands = list()
+        self.watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+
+class MemoryPubSub:
+    ''' Subscription to channels of a MemoryRedis client '''
+
+    def __init__(self, client, ignore_subscribe_messages=False):
+        self.client = client
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.queue = Queue()
+        self.subscribed = set()
+
+    def subscribe(self, *channels):
+        with self.client.lock:
+            for channel in channels:
+                self.client.channels.setdefault(channel, list()).append(self)
+                self.subscribed.add(channel)
+                if not self.ignore_subscribe_messages:
+                    self.queue.put({'type': "subscribe", 'pattern': None, 'channel': channel,
+                                    'data': len(self.subscribed)})
+
+    def unsubscribe(self, *channels):
+        with self.client.lock:
+            for channel in (channels or list(self.subscribed)):
+                if channel in self.subscribed:
+                    self.client.channels[channel].remove(self)
+                    self.subscribed.discard(channel)
+        # Wake up listen()
+        self.queue.put(None)
+
+    close = unsubscribe
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        ''' Return the next message, None if there is none within timeout '''
+        try:
+            return self.queue.get(timeout > 0, timeout or None)
+        except Empty:
+            return None
+
+    def listen(self):
+        ''' Yield messages until unsubscribed from all channels '''
+        while self.subscribed:
+            msg = self.queue.get()
+            if msg is not None:
+                yield msg
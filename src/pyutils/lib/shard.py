@@ -0,0 +1,384 @@
+'''
+Created on Oct 18, 2026
+
+Consistent-hash sharding of Redis commands across several nodes
+
+@requires: redis (pip install redis)
+'''
+
+from bisect import bisect
+from hashlib import md5
+from Queue import Queue, Full
+import threading
+
+DEFAULT_REPLICAS = 160
+# Maximum number of scanned keys waiting to be consumed
+SCAN_BUFFER = 1000
+QUEUE_TIMEOUT = 0.1
+
+# Commands that operate on several keys and must stay on one node
+SAME_NODE_COMMANDS = ("sunion", "sinter", "sdiff", "sunionstore", "sinterstore", "sdiffstore",
+                      "zunionstore", "zinterstore", "rename", "renamenx", "smove", "rpoplpush")
+
+
+def hash_tag(key):
+    ''' Return the part of a key used for routing:
+    the content of the first {...} if any, the whole key otherwise
+    (same convention as Redis Cluster)
+    '''
+    start = key.find("{")
+    if start >= 0:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def _hash(s):
+    ''' 32 bit hash of a string '''
+    return int(md5(s).hexdigest()[:8], 16)
+
+def _command_keys(name, args):
+    ''' Return the keys of a multi-key command, given its arguments '''
+    if name in ("zunionstore", "zinterstore"):
+        # Destination and sources (list or weights map), then aggregate
+        args = args[:2]
+    keys = list()
+    for x in args:
+        keys.extend(x if type(x) in (list, tuple, dict) else [x])
+    return keys
+
+def _parallel(calls):
+    ''' Run callables concurrently, return their results in order.
+    The first exception raised, if any, is re-raised.
+    '''
+    if len(calls) == 1:
+        return [calls[0]()]
+    results = [None] * len(calls)
+    errors = list()
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class HashRing:
+    ''' Consistent hash ring with virtual nodes.
+    Adding or removing a node only moves ~1/N of the keys.
+    '''
+
+    def __init__(self, nodes=None, replicas=DEFAULT_REPLICAS):
+        ''' Create a new ring
+        nodes:      Node names
+        replicas:   Number of virtual nodes per node
+        '''
+        self.replicas = replicas
+        self.ring = dict()
+        self.points = list()
+        for node in (nodes or list()):
+            self.add_node(node)
+
+    def add_node(self, node):
+        ''' Add a node to the ring '''
+        for i in range(self.replicas):
+            self.ring[_hash("%s#%s" % (node, i))] = node
+        self.points = sorted(self.ring.keys())
+
+    def remove_node(self, node):
+        ''' Remove a node from the ring '''
+        for i in range(self.replicas):
+            self.ring.pop(_hash("%s#%s" % (node, i)), None)
+        self.points = sorted(self.ring.keys())
+
+    def get_node(self, key):
+        ''' Return the node a key belongs to '''
+        if not self.points:
+            raise ValueError("No node in hash ring")
+        i = bisect(self.points, _hash(hash_tag(key)))
+        return self.ring[self.points[i % len(self.points)]]
+
+
+class ShardedRedis:
+    ''' Redis client that routes each command to one of several nodes.
+
+    Single key commands are routed by their key. Multi-key reads and
+    deletes fan out to all involved nodes in parallel, while set algebra
+    is rejected unless all keys live on the same node (use hash tags).
+    Pub/sub always goes through the first node.
+    '''
+
+    def __init__(self, clients, replicas=DEFAULT_REPLICAS):
+        ''' Create a new sharded client
+        clients:    Map of node names to StrictRedis clients
+        replicas:   Number of virtual nodes per node
+        '''
+        self.clients = dict(clients)
+        self.names = sorted(self.clients.keys())
+        self.ring = HashRing(self.names, replicas)
+
+    def add_node(self, name, client):
+        ''' Add a node to the ring '''
+        self.clients[name] = client
+        self.names = sorted(self.clients.keys())
+        self.ring.add_node(name)
+
+    def remove_node(self, name):
+        ''' Remove a node from the ring '''
+        self.ring.remove_node(name)
+        self.clients.pop(name)
+        self.names = sorted(self.clients.keys())
+
+    def get_node(self, key):
+        ''' Return the client for the node a key belongs to '''
+        return self.clients[self.ring.get_node(key)]
+
+    def get_node_for(self, *keys):
+        ''' Return the client for the node all given keys belong to.
+        Raise a ValueError if they span several nodes.
+        '''
+        return self.clients[self.get_node_name_for(*keys)]
+
+    def get_node_name_for(self, *keys):
+        ''' Return the name of the node all given keys belong to (see get_node_for) '''
+        nodes = set(self.ring.get_node(k) for k in keys)
+        if len(nodes) > 1:
+            raise ValueError("Keys %s span several shards, use hash tags to keep them together" % (keys,))
+        return nodes.pop()
+
+    def group(self, keys):
+        ''' Group keys by node, return a map of node names to (indexes, keys) '''
+        groups = dict()
+        for i in range(len(keys)):
+            (idx, node_keys) = groups.setdefault(self.ring.get_node(keys[i]), (list(), list()))
+            idx.append(i)
+            node_keys.append(keys[i])
+        return groups
+
+    def __getattr__(self, name):
+        ''' Route any other command by its first argument '''
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in SAME_NODE_COMMANDS:
+            def command(*args, **kw):
+                return getattr(self.get_node_for(*_command_keys(name, args)), name)(*args, **kw)
+        else:
+            def command(key, *args, **kw):
+                return getattr(self.get_node(key), name)(key, *args, **kw)
+        return command
+
+    def mget(self, keys, *args):
+        ''' Get several string values, fanning out to all involved nodes '''
+        keys = list(keys if type(keys) in (list, tuple) else [keys]) + list(args)
+        groups = self.group(keys).items()
+        results = _parallel([lambda n=n, k=k: self.clients[n].mget(k) for (n, (_, k)) in groups])
+        vals = [None] * len(keys)
+        for ((_, (idx, _)), res) in zip(groups, results):
+            for (i, v) in zip(idx, res):
+                vals[i] = v
+        return vals
+
+    def delete(self, *keys):
+        ''' Delete keys on all involved nodes '''
+        return self._fan_out_keys("delete", keys)
+
+    def execute_command(self, *args, **options):
+        ''' Route a raw command by its first key '''
+        if args[0].upper() in ("UNLINK", "DEL", "EXISTS", "TOUCH"):
+            return self._fan_out_keys("execute_command", args[1:], args[0])
+        return self.get_node(args[1]).execute_command(*args, **options)
+
+    def _fan_out_keys(self, method, keys, command=None):
+        ''' Run a multi-key command on each node, return the sum of the results '''
+        prefix = [command] if command else []
+        groups = self.group(list(keys)).items()
+        return sum(_parallel([lambda n=n, k=k: getattr(self.clients[n], method)(*(prefix + k)) for (n, (_, k)) in groups]))
+
+    def scan_iter(self, match=None, count=None):
+        ''' Iterate over matching keys on all nodes, scanned concurrently 
+        (one thread per node, stopped when the iteration is)
+        '''
+        results = Queue(SCAN_BUFFER)
+        stopped = threading.Event()
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=QUEUE_TIMEOUT)
+                    return True
+                except Full:
+                    pass
+            return False
+        def scan(client):
+            try:
+                for key in client.scan_iter(match=match, count=count):
+                    if not put((key, None)):
+                        return
+                put((None, None))
+            except Exception, e:
+                put((None, e))
+        threads = [threading.Thread(target=scan, args=(self.clients[n],)) for n in self.names]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            remaining = len(threads)
+            while remaining:
+                (key, error) = results.get()
+                if error is not None:
+                    raise error
+                if key is None:
+                    remaining -= 1
+                else:
+                    yield key
+        finally:
+            stopped.set()
+
+    def keys(self, pattern="*"):
+        ''' Return matching keys from all nodes '''
+        return sum(_parallel([lambda n=n: self.clients[n].keys(pattern) for n in self.names]), list())
+
+    def dbsize(self):
+        ''' Return the total number of keys '''
+        return sum(_parallel([lambda n=n: self.clients[n].dbsize() for n in self.names]))
+
+    def flushdb(self):
+        ''' Flush all nodes '''
+        return all(_parallel([lambda n=n: self.clients[n].flushdb() for n in self.names]))
+
+    def info(self, *args):
+        ''' Return server info for each node '''
+        return dict(zip(self.names, _parallel([lambda n=n: self.clients[n].info(*args) for n in self.names])))
+
+    def evalsha(self, sha, numkeys, *args):
+        ''' Run a script on the node all its keys belong to '''
+        if numkeys == 0:
+            raise ValueError("Scripts without keys cannot be routed to a shard")
+        return self.get_node_for(*args[:numkeys]).evalsha(sha, numkeys, *args)
+
+    def script_load(self, script):
+        ''' Load a script on all nodes, return its sha '''
+        return _parallel([lambda n=n: self.clients[n].script_load(script) for n in self.names])[0]
+
+    def publish(self, channel, message):
+        return self.clients[self.names[0]].publish(channel, message)
+
+    def pubsub(self, **kw):
+        return self.clients[self.names[0]].pubsub(**kw)
+
+    def transaction(self, func, *watches, **kw):
+        ''' Run a transaction on the node all watched keys belong to '''
+        return self.get_node_for(*watches).transaction(func, *watches, **kw)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        ''' Return a pipeline that splits commands by node.
+        Transactions are atomic per node only.
+        '''
+        return ShardedPipeline(self, transaction)
+
+
+class ShardedPipeline:
+    ''' Pipeline over a ShardedRedis client.
+    Each node gets its own pipeline, all executed in parallel.
+    '''
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.pipes = dict()
+        self.order = list()
+
+    def _pipe(self, name):
+        ''' Return the pipeline for a given node '''
+        if name not in self.pipes:
+            self.pipes[name] = self.client.clients[name].pipeline(self.transaction)
+        return self.pipes[name]
+
+    def __getattr__(self, name):
+        ''' Queue any other command on the node of its first argument,
+        or of all its keys for multi-key commands 
+        '''
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def command(*args, **kw):
+            if name in SAME_NODE_COMMANDS:
+                node = self.client.get_node_name_for(*_command_keys(name, args))
+            else:
+                node = self.client.ring.get_node(args[0])
+            getattr(self._pipe(node), name)(*args, **kw)
+            self.order.append((node, None))
+            return self
+        return command
+
+    def mget(self, keys, *args):
+        ''' Queue a multi-key get split across nodes '''
+        keys = list(keys if type(keys) in (list, tuple) else [keys]) + list(args)
+        groups = self.client.group(keys)
+        for node in groups:
+            self._pipe(node).mget(groups[node][1])
+        self.order.append((None, (len(keys), groups)))
+        return self
+
+    def evalsha(self, sha, numkeys, *args):
+        ''' Queue a script on the node all its keys belong to '''
+        if numkeys == 0:
+            raise ValueError("Scripts without keys cannot be routed to a shard")
+        node = self.client.get_node_name_for(*args[:numkeys])
+        self._pipe(node).evalsha(sha, numkeys, *args)
+        self.order.append((node, None))
+        return self
+
+    def publish(self, channel, message):
+        node = self.client.names[0]
+        self._pipe(node).publish(channel, message)
+        self.order.append((node, None))
+        return self
+
+    def execute_command(self, *args, **options):
+        node = self.client.ring.get_node(args[1])
+        self._pipe(node).execute_command(*args, **options)
+        self.order.append((node, None))
+        return self
+
+    def execute(self, raise_on_error=True):
+        ''' Execute all queued commands, return the results in order '''
+        names = self.pipes.keys()
+        results = _parallel([lambda n=n: self.pipes[n].execute(raise_on_error) for n in names])
+        results = dict((n, iter(r)) for (n, r) in zip(names, results))
+        res = list()
+        for (node, split) in self.order:
+            if node is not None:
+                res.append(results[node].next())
+            else:
+                (n, groups) = split
+                vals = [None] * n
+                for name in groups:
+                    part = results[name].next()
+                    if isinstance(part, Exception):
+                        vals = part
+                        continue
+                    if type(vals) == list:
+                        for (i, v) in zip(groups[name][0], part):
+                            vals[i] = v
+                res.append(vals)
+        self.reset()
+        return res
+
+    def reset(self):
+        ''' Clear all queued commands '''
+        for pipe in self.pipes.values():
+            pipe.reset()
+        self.pipes = dict()
+        self.order = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
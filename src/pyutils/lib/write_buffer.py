@@ -0,0 +1,174 @@
+'''
+Created on Oct 18, 2026
+
+Write-behind buffer for Cache.
+
+Puts return right away and are applied later, in pipelined batches, by a
+background thread. Successive puts to the same key are merged locally:
+ - lists are concatenated (as successive puts append to a list)
+ - sets are merged, as are dictionaries (later fields win)
+Other writes to a key, such as strings (which Cache.put appends to an 
+existing list or set), are kept and applied in order.
+
+Buffered writes are not visible to Cache.get until flushed, and writes
+to different keys may be applied in any order.
+'''
+
+from pyutils.lib.cache import Cache
+from pyutils.utils.logging import Logger
+import threading
+import atexit
+import time
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL = 0.1
+DEFAULT_MAX_PENDING = 100000
+
+class WriteBuffer:
+    ''' Buffered, coalescing front end to Cache.put '''
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING, on_error=None):
+        ''' Create a new buffer and start flushing it in the background
+        batch_size:     Number of pending items that triggers a flush
+        flush_interval: Maximum time in seconds a write stays buffered
+        max_pending:    Maximum number of pending items, puts block beyond that
+        on_error:       Function called with the error and the writes that failed
+                        (default: log the error, the writes are lost)
+        '''
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.pending = dict()
+        self.n_pending = 0
+        self.n_flushing = 0
+        self.waiting = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self._run, name="cache-write-behind")
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def _count(cls, obj):
+        ''' Number of items in a value, used to bound memory '''
+        return len(obj) if type(obj) in (list, set, dict) else 1
+
+    @classmethod
+    def _merge(cls, old, new):
+        ''' Merge two writes to the same key, return None if they cannot be merged '''
+        (old_obj, old_ttl, old_options) = old
+        (obj, ttl, options) = new
+        t = type(obj)
+        if type(old_obj) != t or t not in (list, set, dict) or old_options != options:
+            return None
+        if t == list:
+            obj = old_obj + obj
+        elif t == set:
+            obj = old_obj | obj
+        elif t == dict:
+            merged = dict(old_obj)
+            merged.update(obj)
+            obj = merged
+        return (obj, ttl if ttl is not None else old_ttl, options)
+
+    def put(self, key, obj, ttl=None, **options):
+        ''' Buffer a write, same parameters as Cache.put.
+        Block while the buffer is full.
+        '''
+        if type(obj) not in (str, unicode, list, set, dict):
+            raise ValueError("Unsupported type of cache object: " + str(type(obj)))
+        n = self._count(obj)
+        with self.cond:
+            # Back pressure, wait for the flusher to make room
+            self.waiting += 1
+            while self.n_pending + self.n_flushing + n > self.max_pending and self.n_pending and not self.closed:
+                self.cond.notify_all()
+                self.cond.wait()
+            self.waiting -= 1
+            if not self.closed:
+                write = (obj, ttl, options)
+                writes = self.pending.setdefault(key, list())
+                merged = self._merge(writes[-1], write) if writes else None
+                if merged:
+                    writes[-1] = merged
+                else:
+                    # Applied after the previous writes to the key
+                    writes.append(write)
+                self.n_pending += n
+                if self.n_pending >= self.batch_size:
+                    self.cond.notify_all()
+                return
+        Cache.put(key, obj, ttl, **options)
+
+    def flush(self):
+        ''' Apply all pending writes now '''
+        with self.cond:
+            self._flush_locked()
+
+    def close(self):
+        ''' Apply all pending writes and stop the background thread.
+        Later puts go straight to Cache.
+        '''
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._flush_locked()
+        self.flusher.join()
+
+    def size(self):
+        ''' Return the number of pending items '''
+        return self.n_pending
+
+    def _flush_locked(self):
+        ''' Apply all pending writes, after any batch being flushed (lock must be held) '''
+        while self.n_flushing:
+            self.cond.wait()
+        (batch, self.pending) = (self.pending, dict())
+        self.n_pending = 0
+        self._apply(batch)
+        self.cond.notify_all()
+
+    def _apply(self, batch):
+        ''' Write a batch of writes per key, in rounds applying the n-th write of 
+        each key, with one pipelined put_many per ttl and options 
+        '''
+        n_rounds = max(len(writes) for writes in batch.values()) if batch else 0
+        for i in range(n_rounds):
+            groups = dict()
+            for key in batch:
+                if i < len(batch[key]):
+                    (obj, ttl, options) = batch[key][i]
+                    group = (ttl, tuple(sorted(options.items())))
+                    groups.setdefault(group, dict())[key] = obj
+            for ((ttl, options), mapping) in groups.items():
+                try:
+                    Cache.put_many(mapping, ttl, **dict(options))
+                except Exception, e:
+                    if self.on_error:
+                        self.on_error(e, mapping)
+                    else:
+                        Logger.error("Failed to write %s buffered keys" % len(mapping), e)
+
+    def _run(self):
+        ''' Flush loop '''
+        while True:
+            with self.cond:
+                deadline = time.time() + self.flush_interval
+                while not self.closed and self.n_pending < self.batch_size and not self.waiting:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+                (batch, self.pending) = (self.pending, dict())
+                (self.n_flushing, self.n_pending) = (self.n_pending, 0)
+            if batch:
+                self._apply(batch)
+            with self.cond:
+                self.n_flushing = 0
+                self.cond.notify_all()
@@ -0,0 +1,142 @@
+'''
+Created on Oct 18, 2026
+
+Throughput benchmarks for Cache.
+
+Reports ops/sec and p50/p99 latencies of put and get for each value type
+and size, and of key building. Runs against an in-process MemoryRedis by
+default, so that the numbers only reflect the client-side overhead
+(type dispatch, encoding, decoding, key building), or against a server.
+
+    python bench_cache.py [--redis host:port] [--ops N] [--save FILE]
+                          [--baseline FILE] [--tolerance 0.2]
+
+With --baseline, exits with status 1 if any benchmark is slower than
+in the baseline (as saved with --save) by more than the tolerance.
+'''
+
+from pyutils.lib.cache import Cache
+from pyutils.lib.memory_redis import MemoryRedis
+import argparse
+import json
+import time
+import sys
+
+KEY_PREFIX = "bench:"
+DEFAULT_OPS = 1000
+DEFAULT_TOLERANCE = 0.2
+WARMUP_OPS = 10
+
+# Number of items for containers, number of bytes for strings
+ITEM_COUNTS = (1, 10, 100, 1000)
+STR_SIZES = (10, 1000, 100000)
+
+
+def make_value(t, size):
+    ''' Build a value of a given type and size '''
+    if t == "str":
+        return "x" * size
+    elif t == "list":
+        return range(size)
+    elif t == "set":
+        return set(range(size))
+    elif t == "dict":
+        return dict(("k%s" % i, i) for i in range(size))
+    elif t == "sorted":
+        return dict(("m%s" % i, float(i)) for i in range(size))
+    raise ValueError("Unknown value type: %s" % t)
+
+def cases():
+    ''' Return the (type, size) pairs to benchmark '''
+    res = [("str", size) for size in STR_SIZES]
+    for t in ("list", "set", "dict", "sorted"):
+        res.extend((t, size) for size in ITEM_COUNTS)
+    return res
+
+def measure(f, ops):
+    ''' Call f(i) for i in 0..ops-1, return ops/sec, p50 and p99 latencies in microseconds '''
+    for i in range(WARMUP_OPS):
+        f(i)
+    timings = list()
+    start = time.time()
+    for i in range(ops):
+        t = time.time()
+        f(i)
+        timings.append(time.time() - t)
+    elapsed = time.time() - start
+    timings.sort()
+    return {'ops_per_sec': ops / elapsed if elapsed else float("inf"),
+            'p50_us': timings[int(0.50 * (len(timings) - 1))] * 1e6,
+            'p99_us': timings[int(0.99 * (len(timings) - 1))] * 1e6}
+
+def run(ops=DEFAULT_OPS):
+    ''' Run all benchmarks, return a map of benchmark names to results '''
+    results = dict()
+    for (t, size) in cases():
+        obj = make_value(t, size)
+        sorted_set = (t == "sorted")
+
+        # Fresh keys, so that lists and sets do not grow across puts
+        put = lambda i: Cache.put("%sput:%s" % (KEY_PREFIX, i), obj, sorted=sorted_set)
+        results["put/%s/%s" % (t, size)] = measure(put, ops)
+        Cache.remove(KEY_PREFIX + "*", False)
+
+        key = KEY_PREFIX + "get"
+        Cache.put(key, obj, sorted=sorted_set)
+        get = lambda i: Cache.get(key)
+        results["get/%s/%s" % (t, size)] = measure(get, ops)
+        Cache.remove(KEY_PREFIX + "*", False)
+
+    params = {'q': "some query", 'page': 2, 'filters': ["a", "b"]}
+    key = lambda i: Cache.make_ns_key(Cache.NS_REQUEST, "controller", "action", params)
+    results["make_ns_key"] = measure(key, ops)
+    return results
+
+def report(results, out=sys.stdout):
+    ''' Print results as a table '''
+    out.write("%-22s %14s %10s %10s\n" % ("benchmark", "ops/sec", "p50 (us)", "p99 (us)"))
+    for name in sorted(results):
+        res = results[name]
+        out.write("%-22s %14.0f %10.1f %10.1f\n" % (name, res['ops_per_sec'], res['p50_us'], res['p99_us']))
+
+def regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    ''' Return the (name, ops/sec, baseline ops/sec) of benchmarks slower than
+    their baseline by more than tolerance (fraction of the baseline)
+    '''
+    res = list()
+    for name in sorted(results):
+        if name in baseline:
+            (now, then) = (results[name]['ops_per_sec'], baseline[name]['ops_per_sec'])
+            if now < then * (1 - tolerance):
+                res.append((name, now, then))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache throughput benchmarks")
+    parser.add_argument("--redis", help="host:port of a Redis server (default: in-process MemoryRedis)")
+    parser.add_argument("--ops", type=int, default=DEFAULT_OPS, help="operations per benchmark")
+    parser.add_argument("--save", help="file to save the results to (JSON)")
+    parser.add_argument("--baseline", help="results to compare against (JSON)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    if args.redis:
+        (host, port) = args.redis.split(":")
+        Cache.init(host=host, port=int(port))
+    else:
+        Cache.init(client=MemoryRedis())
+
+    results = run(args.ops)
+    report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for (name, now, then) in slower:
+            print "REGRESSION %s: %.0f ops/sec (baseline %.0f)" % (name, now, then)
+        if slower:
+            sys.exit(1)
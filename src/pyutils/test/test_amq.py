@@ -0,0 +1,321 @@
+'''
+Created on Oct 18, 2026
+
+AMQ tests against fake connections (no server needed)
+'''
+
+import socket
+import os
+import threading
+from Queue import Queue
+from amqplib import client_0_8 as amqp
+from amqplib.client_0_8.method_framing import MethodWriter
+from amqplib.client_0_8.transport import _AbstractTransport
+from pyutils.lib.unit_test import TestSuite, test_case
+from pyutils.lib.amq import AMQ, TopicMatcher, SHUTDOWN
+from pyutils.lib.async_amq import AsyncAMQ
+
+TEST_CONFIG = { "host": "localhost", "port": 5672, "exchange": "test" }
+TEST_QUEUE = "test_queue"
+TEST_KEY = "test.key"
+TIMEOUT = 10
+FRAME_MAX = 131072
+
+class FakeMessage:
+    ''' Delivered message '''
+
+    def __init__(self, body, routing_key, delivery_tag):
+        self.body = body
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+        self.consumer_tag = "test_consumer"
+
+
+class FakeChannel:
+    ''' Channel to a broker delivering one queue, no more than prefetch
+    messages being unsettled at once. Requeued messages are left for
+    other consumers.
+    '''
+
+    def __init__(self, connection, messages):
+        self.connection = connection
+        self.pending = list(messages)
+        self.unsettled = dict()
+        self.ready = list()
+        self.prefetch = 0
+        self.next_tag = 1
+        self.callback = None
+        self.cancelled = False
+        self.method_queue = list()
+        self.acks = list()
+        self.ack_calls = 0
+        self.rejects = list()
+
+    def exchange_declare(self, exchange, type, durable=False):
+        pass
+
+    def queue_declare(self, queue, durable=False, auto_delete=True):
+        pass
+
+    def queue_bind(self, queue, exchange, routing_key):
+        pass
+
+    def basic_qos(self, prefetch_size, prefetch_count, a_global):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, callback):
+        self.callback = callback
+        self._deliver()
+
+    def basic_cancel(self, consumer_tag):
+        self.cancelled = True
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        tags = sorted(t for t in self.unsettled if t <= delivery_tag) if multiple else [delivery_tag]
+        for tag in tags:
+            self.unsettled.pop(tag)
+        self.acks.extend(tags)
+        self.ack_calls += 1
+        self._deliver()
+
+    def basic_reject(self, delivery_tag, requeue):
+        (body, key) = self.unsettled.pop(delivery_tag)
+        self.rejects.append((body, requeue))
+        self._deliver()
+
+    def _deliver(self):
+        ''' Deliver pending messages within the prefetch limit '''
+        while (self.callback and not self.cancelled and self.pending
+               and (not self.prefetch or len(self.unsettled) < self.prefetch)):
+            (body, key) = self.pending.pop(0)
+            msg = FakeMessage(body, key, self.next_tag)
+            self.next_tag += 1
+            self.unsettled[msg.delivery_tag] = (body, key)
+            self.ready.append(msg)
+            self.connection.feed.send("x")
+
+    def wait(self):
+        self.connection.sock.recv(1)
+        if self.connection.closed:
+            raise IOError("Connection closed")
+        self.callback(self.ready.pop(0))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    ''' Connection whose socket is readable for each message delivered '''
+
+    def __init__(self, messages):
+        (self.sock, self.feed) = socket.socketpair()
+        self.transport = self
+        self.method_reader = self
+        self.queue = Queue()
+        self.closed = False
+        self.chan = FakeChannel(self, messages)
+
+    def channel(self):
+        return self.chan
+
+    def close(self):
+        self.closed = True
+        self.feed.send("x")
+
+
+class FakeTransport(_AbstractTransport):
+    ''' Transport recording what is written to the socket '''
+
+    def __init__(self):
+        self.sock = None
+        self.writes = list()
+
+    def _write(self, s):
+        self.writes.append(s)
+
+
+class FakePublisherConnection:
+    ''' Connection framing methods as amqplib does, over a FakeTransport '''
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.method_writer = MethodWriter(self.transport, FRAME_MAX)
+        # Open channel, without the handshake
+        self.chan = amqp.Channel.__new__(amqp.Channel)
+        self.chan.connection = self
+        self.chan.channel_id = 1
+        self.chan.default_ticket = 0
+
+    def channel(self):
+        return self.chan
+
+
+class TestAMQ(TestSuite):
+    ''' Unit test for AMQ publishers and consumers '''
+
+    def setup(self):
+        AMQ.enable_verbose(False)
+
+    def teardown(self):
+        AMQ.enable_verbose(True)
+
+    def _publisher(self):
+        ''' Return a publisher connected to a fake transport '''
+        amq = AMQ(TEST_CONFIG)
+        amq.connection = FakePublisherConnection()
+        amq.channel = amq.connection.channel()
+        amq.on = True
+        return amq
+
+    def _monitor(self, messages, handler, routing_key=None, **params):
+        ''' Consume messages followed by a shutdown signal from a fake broker,
+        return the channel once done
+        '''
+        amq = AMQ(TEST_CONFIG, TEST_QUEUE, handler)
+        amq.connection = FakeConnection([(m, TEST_KEY) if type(m) == str else m for m in messages]
+                                        + [(SHUTDOWN, TEST_KEY)])
+        amq.channel = amq.connection.channel()
+        amq.queue_exists = True
+        amq.on = True
+        t = threading.Thread(target=amq.monitor, args=(routing_key,), kwargs=params)
+        t.daemon = True
+        t.start()
+        t.join(TIMEOUT)
+        # Stalled with unsettled messages otherwise
+        self.assert_false(t.is_alive())
+        self.assert_equal(amq.channel.unsettled, dict())
+        return amq.channel
+
+    def _failing_handler(self, handled):
+        ''' Return a handler failing for "bad" messages '''
+        def handler(body, **params):
+            if body == "bad":
+                raise Exception("Bad message")
+            handled.append(body)
+        return handler
+
+    @test_case
+    def test0_publish_many(self):
+        ''' Test writing messages published together to the socket at once '''
+        messages = ["m%s" % i for i in range(5)] + [{ "a": 1 }]
+        amq = self._publisher()
+        for m in messages:
+            amq.publish(m, TEST_KEY)
+        writes = amq.connection.transport.writes
+        self.assert_equal(len(writes), 3 * len(messages))
+        amq = self._publisher()
+        self.assert_equal(amq.publish_many(messages, TEST_KEY), len(messages))
+        self.assert_equal(amq.connection.transport.writes, ["".join(writes)])
+        # One write per batch flush
+        amq = self._publisher()
+        with amq.batch(size=4) as batch:
+            for m in messages:
+                batch.publish(m, TEST_KEY)
+        self.assert_equal(batch.published, len(messages))
+        self.assert_equal(len(amq.connection.transport.writes), 2)
+        self.assert_equal("".join(amq.connection.transport.writes), "".join(writes))
+
+    @test_case
+    def test1_reject_failures(self):
+        ''' Test rejecting messages whose handler fails, so that they do not hold prefetch slots '''
+        handled = list()
+        channel = self._monitor(["bad"] * 3 + ["ok"] * 2, self._failing_handler(handled),
+                                prefetch=2, requeue=False)
+        self.assert_equal(handled, ["ok"] * 2)
+        self.assert_equal(channel.rejects, [("bad", False)] * 3)
+        self.assert_equal(len(channel.acks), 3)
+
+    @test_case
+    def test2_reject_failures_with_workers(self):
+        ''' Test rejecting messages whose handler fails, with several workers '''
+        for ordered in (False, True):
+            handled = list()
+            channel = self._monitor(["bad"] * 5 + ["ok"] * 3, self._failing_handler(handled),
+                                    workers=2, ordered_acks=ordered)
+            self.assert_equal(handled, ["ok"] * 3)
+            self.assert_equal(channel.rejects, [("bad", True)] * 5)
+            self.assert_equal(len(channel.acks), 4)
+
+    @test_case
+    def test3_requeue_unmatched(self):
+        ''' Test requeueing messages matching no binding, for other consumers of the queue '''
+        for workers in (1, 2):
+            handled = list()
+            messages = [("other", "other.key")] * 5 + ["ok"]
+            channel = self._monitor(messages, self._failing_handler(handled), TEST_KEY,
+                                    workers=workers, prefetch=2)
+            self.assert_equal(handled, ["ok"])
+            self.assert_equal(channel.rejects, [("other", True)] * 5)
+
+    @test_case
+    def test4_requeue_crashed_worker(self):
+        ''' Test requeueing a message whose worker process dies, whatever the requeue setting '''
+        def handler(body, **params):
+            if body == "die":
+                os._exit(1)
+            if body == "bad":
+                raise Exception("Bad message")
+        channel = self._monitor(["die", "bad", "ok"], handler, processes=True, requeue=False)
+        self.assert_equal(channel.rejects, [("die", True), ("bad", False)])
+        self.assert_equal(len(channel.acks), 2)
+
+    @test_case
+    def test5_fetch_async_messages(self):
+        ''' Test fetching messages as futures, and rejecting some '''
+        conn = FakeConnection([(m, TEST_KEY) for m in ("a", "b", "c", SHUTDOWN)])
+        connection = amqp.Connection
+        amqp.Connection = lambda host, user, pwd: conn
+        try:
+            messages = AsyncAMQ(TEST_CONFIG, TEST_QUEUE, concurrency=2).messages(TEST_KEY)
+            received = list()
+            while True:
+                delivery = messages.fetch().result(TIMEOUT)
+                if delivery is None:
+                    break
+                received.append(delivery.body)
+                if delivery.body == "b":
+                    delivery.reject()
+                else:
+                    delivery.ack()
+            messages.consumer.result(TIMEOUT)
+        finally:
+            amqp.Connection = connection
+        self.assert_equal(sorted(received), ["a", "b", "c"])
+        self.assert_equal(conn.chan.rejects, [("b", True)])
+        self.assert_equal(conn.chan.unsettled, dict())
+
+    @test_case
+    def test6_topic_matcher(self):
+        ''' Test matching routing keys against topic patterns '''
+        matcher = TopicMatcher()
+        for (i, pattern) in enumerate(["a.*", "a.#", "#", "*.b.c", "a.b.c", "a.*", "a.#.c"]):
+            matcher.add(pattern, i)
+        self.assert_equal(matcher.match("a.b"), [0, 1, 2, 5])
+        self.assert_equal(matcher.match("a"), [1, 2])
+        self.assert_equal(matcher.match("a.b.c"), [1, 2, 3, 4, 6])
+        self.assert_equal(matcher.match("a.c"), [0, 1, 2, 5, 6])
+        self.assert_equal(matcher.match("x.b.c"), [2, 3])
+        self.assert_equal(matcher.match("b"), [2])
+        # Cached results are dropped when adding a pattern
+        matcher.add("b", 7)
+        self.assert_equal(matcher.match("b"), [2, 7])
+
+    @test_case
+    def test7_batched_acks(self):
+        ''' Test acknowledging handled messages together, rejecting the others '''
+        messages = ["m%s" % i for i in range(4)] + ["bad", ("other", "other.key")] + ["m%s" % i for i in range(5)]
+        for params in ({ "ack_every": 3 }, { "ack_every": 100, "ack_interval": 0.05 }, { "ack_interval": 0 }):
+            for workers in (1, 4):
+                handled = list()
+                channel = self._monitor(messages, self._failing_handler(handled), TEST_KEY,
+                                        workers=workers, requeue=False, **params)
+                self.assert_equal(sorted(handled), sorted(m for m in messages if m not in ("bad", ("other", "other.key"))))
+                self.assert_equal(sorted(channel.rejects), [("bad", False), ("other", True)])
+                # Including the shutdown signal
+                self.assert_equal(len(channel.acks), len(messages) - 1)
+                if params.get("ack_every"):
+                    self.assert_lt(channel.ack_calls, len(channel.acks))
+
+
+if __name__ == "__main__":
+    TestAMQ().run()
@@ -11,8 +11,39 @@ TEST_DICT = { "a":1, "b":"fds", "c":False }
 TEST_SET = set(TEST_LIST)
 TEST_SORTED_SET = { 'name1':4.0, 'name2':3.0, 'name3':2.0, 'name4':1.0 }
 
+import sys
+import time
+import itertools
 from pyutils.lib.unit_test import TestSuite, test_case
 from pyutils.lib.cache import Cache
+from pyutils.lib.codec import ReprCodec, MarshalCodec, MAGIC
+from pyutils.lib.shard import HashRing, ShardedRedis
+from pyutils.lib.memoize import cached
+from pyutils.lib.async_cache import AsyncCache
+from pyutils.lib.memory_redis import MemoryRedis
+from pyutils.lib.write_buffer import WriteBuffer
+from pyutils.lib.bloom import KeyFilter, REDIS_PREFIX as BLOOM_PREFIX
+
+class HookedRedis:
+    ''' Redis client running a hook before executing the next pipeline '''
+    
+    def __init__(self, r):
+        self.r = r
+        self.hook = None
+    
+    def __getattr__(self, name):
+        return getattr(self.r, name)
+    
+    def pipeline(self, *args, **kw):
+        pipe = self.r.pipeline(*args, **kw)
+        execute = pipe.execute
+        def hooked_execute(*args, **kw):
+            (hook, self.hook) = (self.hook, None)
+            if hook:
+                hook()
+            return execute(*args, **kw)
+        pipe.execute = hooked_execute
+        return pipe
 
 class TestCache(TestSuite):
     ''' Unit test for Cache '''
@@ -159,5 +190,524 @@ class TestCache(TestSuite):
         self.assert_not_none(keys)
         self.assert_equal(len(keys), 10)
 
+    @test_case
+    def test10_put_with_ttl(self):
+        ''' Test putting values and their ttl in one batch '''
+        
+        key = TEST_KEY + "_batch"
+        Cache.put(key, range(1000), ttl=60)
+        self.assert_equal(Cache.size(key), 1000)
+        self.assert_gt(self.r.ttl(key), 0)
+        Cache.put(key, TEST_STR, ttl=60, atomic=True)
+        self.assert_equal(Cache.size(key), 1001)
+        self.assert_gt(self.r.ttl(key), 0)
+        Cache.remove(key, False)
+        self.assert_false(Cache.has(key))
+
+    @test_case
+    def test11_get_and_put_many(self):
+        ''' Test getting/putting several values at once '''
+        
+        keys = [TEST_KEY + "_many_%s" % x for x in ("str", "list", "dict", "set")]
+        Cache.put_many(dict(zip(keys, [TEST_STR, TEST_LIST, TEST_DICT, TEST_SET])), ttl=60)
+        vals = Cache.get_many([keys[0], "missing_key"] + keys[1:])
+        self.assert_equal(vals, [TEST_STR, None, TEST_LIST, TEST_DICT, TEST_SET])
+        self.assert_gt(self.r.ttl(keys[3]), 0)
+        for key in keys:
+            Cache.remove(key, False)
+        self.assert_equal(Cache.get_many(keys), [None] * len(keys))
+
+    @test_case
+    def test12_codecs(self):
+        ''' Test round-tripping values through a tagged codec '''
+        
+        key = TEST_KEY + "_codec"
+        values = ["1", 1, 1.5, u"\u00e9t\u00e9", (1, "a"), None, False]
+        Cache.set_codec(MarshalCodec())
+        try:
+            Cache.put(key, values)
+            self.assert_equal(Cache.get(key), values)
+            Cache.remove(key, False)
+            Cache.put(key, "1")
+            self.assert_equal(Cache.get(key), "1")
+        finally:
+            Cache.set_codec(ReprCodec())
+        
+        # Values written by a tagged codec stay readable
+        self.assert_equal(Cache.get(key), "1")
+        
+        # Legacy values are parsed as literals, never evaluated
+        self.r.set(key, "[1, 'a', None]")
+        self.assert_equal(Cache.get(key), [1, 'a', None])
+        self.r.set(key, "__import__('os')")
+        self.assert_equal(Cache.get(key), "__import__('os')")
+        
+        # Strings looking like tagged values are kept as is
+        Cache.remove(key, False)
+        Cache.put(key, MAGIC + "sabc")
+        self.assert_equal(Cache.get(key), MAGIC + "sabc")
+        Cache.remove(key, False)
+
+    @test_case
+    def test13_local_tier(self):
+        ''' Test serving reads from the in-process tier '''
+        
+        key = Cache.make_ns_key(Cache.NS_GEO_LOC, "test", "local")
+        Cache.enable_local(max_entries=10, namespaces=[Cache.NS_GEO_LOC], channel=None)
+        try:
+            Cache.put(key, TEST_DICT, ttl=60)
+            self.assert_equal(Cache.get(key), TEST_DICT)
+            self.assert_equal(Cache.local.size(), 1)
+            
+            # Reads are served locally until the key is written through Cache
+            self.r.hset(key, "a", 2)
+            self.assert_equal(Cache.get(key), TEST_DICT)
+            self.assert_equal(Cache.get_many([key]), [TEST_DICT])
+            Cache.put(key, {"a": 3})
+            self.assert_equal(Cache.get(key)["a"], 3)
+            
+            Cache.remove(key, False)
+            self.assert_equal(Cache.local.size(), 0)
+            self.assert_none(Cache.get(key))
+            
+            # Values read before an invalidation are not cached after it
+            version = Cache.local.version(key)
+            Cache.local.delete(key)
+            Cache.local.set(key, TEST_DICT, version=version)
+            self.assert_none(Cache.local.get(key))
+            
+            # Keys looking like patterns are invalidated too
+            Cache.local.set(key + "[1]", TEST_DICT)
+            Cache.local.delete(key + "[1]")
+            self.assert_none(Cache.local.get(key + "[1]"))
+            
+            # but not taken as patterns
+            key = Cache.make_ns_key(Cache.NS_GEO_LOC, "test", "local", {"id": 1})
+            other = key.replace("?", "x")
+            Cache.local.set(other, TEST_DICT)
+            version = Cache.local.version(other)
+            Cache.put(key, TEST_DICT)
+            self.assert_equal(Cache.local.get(other), TEST_DICT)
+            self.assert_equal(Cache.local.version(other), version)
+            Cache.local.invalidate((), [key])
+            self.assert_none(Cache.local.get(other))
+            Cache.remove(key, False, exact=True)
+        finally:
+            Cache.disable_local()
+
+    @test_case
+    def test14_scan_and_remove(self):
+        ''' Test scanning keys and removing them in batches '''
+        
+        base_key = "test_key_scan_"
+        Cache.put_many(dict(("%s%s" % (base_key, i), str(i)) for i in range(25)))
+        keys = list(Cache.iter_keys("%s*" % base_key, count=10))
+        self.assert_equal(len(set(keys)), 25)
+        
+        removed = dict(Cache.iter_remove("%s1*" % base_key, get_val=True, count=4))
+        self.assert_equal(len(removed), 11)
+        self.assert_equal(removed[base_key + "12"], 12)
+        vals = Cache.remove("%s*" % base_key, count=4)
+        self.assert_equal(sorted(vals), [0] + range(2, 10) + range(20, 25))
+        self.assert_equal(Cache.keys("%s*" % base_key), [])
+        
+        # Values decoding to None are still returned
+        Cache.put_many({base_key + "a": "None", base_key + "b": TEST_STR})
+        self.assert_equal(sorted(Cache.remove("%s*" % base_key)), [None, TEST_STR])
+        
+        # Keys with wildcards can be removed as is
+        key = Cache.make_ns_key(Cache.NS_GEO_LOC, "test", "remove", {"id": 1})
+        other = key.replace("?", "x")
+        Cache.put_many({key: TEST_STR, other: TEST_STR})
+        self.assert_equal(Cache.remove(key, exact=True), TEST_STR)
+        self.assert_false(Cache.has(key))
+        self.assert_true(Cache.has(other))
+        Cache.remove(other, False)
+
+    @test_case
+    def test15_connection_pools(self):
+        ''' Test sharing connection pools between instances '''
+        
+        if isinstance(Cache.instance.redis, MemoryRedis):
+            # Needs a server
+            return
+        
+        c1 = Cache.get_instance(db=1)
+        c2 = Cache.get_instance(db=1)
+        self.assert_is(c1.redis.connection_pool, c2.redis.connection_pool)
+        self.assert_is_not(c1.redis.connection_pool, Cache.instance.redis.connection_pool)
+        self.assert_is(Cache.get_instance(), Cache.instance)
+        
+        c1.redis.set(TEST_KEY, TEST_STR)
+        self.assert_false(Cache.has(TEST_KEY))
+        c1.redis.delete(TEST_KEY)
+        self.assert_in("%s:%s/1" % (Cache.DEFAULT_HOST, Cache.DEFAULT_PORT), Cache.pool_stats())
+        
+        # Existing pools are resized
+        c3 = Cache.get_instance(db=1, pool_size=Cache.DEFAULT_POOL_SIZE + 1)
+        self.assert_is(c3.redis.connection_pool, c1.redis.connection_pool)
+        self.assert_equal(c1.redis.connection_pool.max_connections, Cache.DEFAULT_POOL_SIZE + 1)
+
+    @test_case
+    def test16_hash_ring(self):
+        ''' Test routing keys across shards '''
+        
+        ring = HashRing(["node1", "node2", "node3"])
+        keys = ["%s_%s" % (TEST_KEY, i) for i in range(3000)]
+        before = [ring.get_node(k) for k in keys]
+        for node in ("node1", "node2", "node3"):
+            self.assert_gt(before.count(node), 500)
+        self.assert_equal(ring.get_node("{user1}_a"), ring.get_node("{user1}_b"))
+        
+        # Adding a node only moves the keys it takes over
+        ring.add_node("node4")
+        moved = [k for (k, n) in zip(keys, before) if ring.get_node(k) != n]
+        self.assert_lt(len(moved), len(keys) / 2)
+        for k in moved:
+            self.assert_equal(ring.get_node(k), "node4")
+        
+        # Set algebra across shards is rejected, pipelined or not
+        sharded = ShardedRedis({"node1": MemoryRedis(), "node2": MemoryRedis()})
+        k1 = keys[0]
+        k2 = [k for k in keys if sharded.ring.get_node(k) != sharded.ring.get_node(k1)][0]
+        old = Cache.instance
+        Cache.init(client=sharded)
+        try:
+            Cache.put(k1, TEST_SORTED_SET, sorted=True)
+            Cache.put(k2, TEST_SORTED_SET, sorted=True)
+            # Nodes are scanned concurrently
+            scanned = ["%s_scan_%s" % (TEST_KEY, i) for i in range(2000)]
+            Cache.put_many(dict((k, TEST_STR) for k in scanned))
+            self.assert_equal(sorted(Cache.keys(TEST_KEY + "_scan_*")), sorted(scanned))
+            self.assert_equal(len(list(itertools.islice(Cache.iter_keys("*", count=10), 5))), 5)
+            for op in (lambda: Cache.union(k1, k2), lambda: Cache.inter(k1, k2, inplace=True)):
+                try:
+                    op()
+                    self.fail("Set operation across shards should fail")
+                except ValueError:
+                    pass
+        finally:
+            Cache.instance = old
+            Cache.has_unlink = True
+            Cache.has_scripting = None
+
+    @test_case
+    def test17_cached(self):
+        ''' Test memoizing function results '''
+        
+        calls = list()
+        
+        @cached(Cache.NS_REQUEST, ttl=60, beta=0)
+        def compute(x, y=1):
+            calls.append(x)
+            return [x, y]
+        
+        self.assert_equal(compute(1, y=2), [1, 2])
+        self.assert_equal(compute(1, 2), [1, 2])
+        self.assert_equal(compute(2), [2, 1])
+        self.assert_equal(calls, [1, 2])
+        self.assert_true(Cache.has(compute.make_key(1, 2)))
+        
+        compute.invalidate(1, 2)
+        compute.invalidate(2)
+        self.assert_equal(compute(1, 2), [1, 2])
+        self.assert_equal(calls, [1, 2, 1])
+        compute.invalidate(1, 2)
+        
+        # Falsy arguments and string results are kept apart
+        @cached(Cache.NS_REQUEST, ttl=60, beta=0)
+        def echo(x):
+            return x
+        args = [0, None, "", False, "123", [1, 2]]
+        self.assert_equal([echo(x) for x in args], args)
+        self.assert_equal([echo(x) for x in args], args)
+        self.assert_equal(type(echo("123")), str)
+        for x in args:
+            echo.invalidate(x)
+            self.assert_false(Cache.has(echo.make_key(x)))
+
+    @test_case
+    def test18_make_ns_key(self):
+        ''' Test building namespaced keys '''
+        
+        params = {"b": 2, "a": "x&y", "c": 0}
+        key = Cache.make_ns_key(Cache.NS_REQUEST, "ctrl", "action", params)
+        self.assert_equal(key, "req_ctrl_action?a=x&y&b=2")
+        self.assert_equal(Cache.make_ns_key(Cache.NS_REQUEST, "ctrl", "action", dict(reversed(params.items()))), key)
+        self.assert_equal(Cache.make_ns_key(Cache.NS_REQUEST, "ctrl", "action", params, strict=True), 
+                          "req_ctrl_action?a=x%26y&b=2&c=0")
+        
+        key = Cache.make_ns_key(Cache.NS_WEB_PAGE, "ctrl", "action", {"q": "x" * 500}, max_length=100)
+        self.assert_true(key.startswith("web_ctrl_action#"))
+        self.assert_lt(len(key), 100)
+        
+        keys = Cache.make_ns_keys(Cache.NS_GEO_LOC, "ctrl", None, [{"id": 1}, {"id": 2}])
+        self.assert_equal(keys, ["geo_ctrl?id=1", "geo_ctrl?id=2"])
+        
+        key = Cache.make_ns_key(Cache.NS_REQUEST, u"ctrl", u"action", {"q": u"\u00e9"})
+        self.assert_equal(key, "req_ctrl_action?q=\xc3\xa9")
+
+    @test_case
+    def test19_compound_operations(self):
+        ''' Test operations combining several steps '''
+        
+        key = TEST_KEY + "_compound"
+        Cache.put(key, TEST_LIST)
+        Cache.put(key, TEST_STR, ttl=60)
+        self.assert_equal(Cache.get(key), TEST_LIST + [TEST_STR])
+        self.assert_gt(self.r.ttl(key), 0)
+        self.assert_equal(Cache.remove(key), TEST_LIST + [TEST_STR])
+        self.assert_false(Cache.has(key))
+        
+        Cache.put(key, TEST_STR)
+        try:
+            Cache.union(key, key, inplace=True)
+            self.fail("Union of strings should fail")
+        except ValueError:
+            pass
+        Cache.remove(key, False)
+
+    @test_case
+    def test20_async(self):
+        ''' Test concurrent non-blocking calls '''
+        
+        keys = ["%s_async_%s" % (TEST_KEY, i) for i in range(20)]
+        AsyncCache.gather(*[AsyncCache.put(key, TEST_LIST) for key in keys])
+        vals = AsyncCache.gather(*[AsyncCache.get(key) for key in keys], timeout=10)
+        self.assert_equal(vals, [TEST_LIST] * len(keys))
+        self.assert_true(AsyncCache.has(keys[0]).result())
+        AsyncCache.gather(*[AsyncCache.remove(key, False) for key in keys])
+        self.assert_equal(AsyncCache.get_many(keys).result(), [None] * len(keys))
+
+    @test_case
+    def test21_compression(self):
+        ''' Test compressing large values '''
+        
+        key = TEST_KEY + "_compressed"
+        page = "<html>%s</html>" % ("<p>%s</p>" % TEST_STR * 1000)
+        Cache.enable_compression(threshold=100)
+        try:
+            Cache.put(key, [page, TEST_STR])
+            self.assert_lt(len(self.r.lindex(key, 0)), len(page) / 10)
+            self.assert_equal(self.r.lindex(key, 1), TEST_STR)
+            self.assert_equal(Cache.get(key), [page, TEST_STR])
+            stats = Cache.compression_stats()
+            self.assert_equal(stats['compressed'], 1)
+            self.assert_lt(stats['ratio'], 0.1)
+        finally:
+            Cache.disable_compression()
+        self.assert_none(Cache.compression_stats())
+        self.assert_equal(Cache.get(key), [page, TEST_STR])
+        Cache.remove(key, False)
+        
+        # Legacy values looking compressed are read as is
+        self.r.set(key, MAGIC + "zabc")
+        self.assert_equal(Cache.get(key), MAGIC + "zabc")
+        Cache.remove(key, False)
+
+    @test_case
+    def test22_stats(self):
+        ''' Test recording cache stats '''
+        
+        key = Cache.make_ns_key(Cache.NS_WEB_PAGE, "test", "stats")
+        Cache.enable_stats()
+        try:
+            Cache.put(key, TEST_LIST)
+            Cache.get(key)
+            Cache.get_many([key, key + "_missing"])
+            # Not a lookup
+            Cache.remove(key)
+            stats = Cache.stats_snapshot()
+        finally:
+            Cache.disable_stats()
+        
+        web = stats['namespaces'][Cache.NS_WEB_PAGE]
+        self.assert_equal(web['hits'], 2)
+        self.assert_equal(web['misses'], 1)
+        self.assert_gt(web['bytes_written'], 0)
+        self.assert_equal(web['bytes_read'], 3 * web['bytes_written'])
+        self.assert_equal(stats['ops']['get']['count'], 1)
+        self.assert_equal(sum(stats['ops']['put']['histogram'].values()), 1)
+        self.assert_none(Cache.stats_snapshot())
+
+    @test_case
+    def test23_iter(self):
+        ''' Test streaming large values '''
+        
+        key = TEST_KEY + "_iter"
+        Cache.put(key, range(2500))
+        self.assert_equal(list(Cache.iter(key, batch=1000)), range(2500))
+        self.assert_equal(Cache.get(key, range=(10, 14)), range(10, 15))
+        Cache.remove(key, False)
+        
+        Cache.put(key, dict(("k%s" % i, i) for i in range(500)))
+        self.assert_equal(dict(Cache.iter(key, batch=100)), dict(("k%s" % i, i) for i in range(500)))
+        Cache.remove(key, False)
+        
+        Cache.put(key, set(range(500)))
+        self.assert_equal(set(Cache.iter(key, batch=100)), set(range(500)))
+        Cache.remove(key, False)
+        
+        Cache.put(key, TEST_SORTED_SET, sorted=True)
+        self.assert_equal(dict(Cache.iter(key)), TEST_SORTED_SET)
+        Cache.remove(key, False)
+        self.assert_equal(list(Cache.iter(key)), [])
+
+    @test_case
+    def test24_set_op_results(self):
+        ''' Test reusing stored set operation results '''
+        
+        # Hash tags keep the keys together when sharded
+        (key1, key2) = ("{setop}1", "{setop}2")
+        Cache.put(key1, set(range(5)))
+        Cache.put(key2, set(range(3, 8)))
+        try:
+            (res1, n) = Cache.union(key1, key2, inplace=True)
+            (res2, _) = Cache.union(key2, key1, inplace=True)
+            self.assert_equal(n, 8)
+            self.assert_equal(res1, res2)
+            self.assert_equal(Cache.union_card(key1, key2), 8)
+            self.assert_equal(Cache.inter_card(key1, key2), 2)
+            
+            Cache.enable_set_op_reuse()
+            (res, n) = Cache.inter(key1, key2, inplace=True)
+            self.assert_equal(n, 2)
+            # Written behind Cache's back, the result is reused
+            self.r.sadd(key1, "6")
+            self.assert_equal(Cache.inter(key1, key2, inplace=True), (res, 2))
+            # Written through Cache, it is recomputed
+            Cache.put(key1, "7")
+            self.assert_equal(Cache.inter(key1, key2, inplace=True), (res, 4))
+
+            # Written keys are not taken as patterns, even with wildcards
+            (key3, key4) = ("{setop}3?id=[1]", "{setop}3xid=1")
+            Cache.put(key4, set(range(5)))
+            (res, _) = Cache.inter(key4, key2, inplace=True)
+            Cache.put(key3, set(range(2)))
+            self.assert_true(self.r.exists(res))
+            Cache.put(key4, "9")
+            self.assert_false(self.r.exists(res))
+
+            Cache.remove("{setop}*", False)
+            Cache.put(key1, {'a': 1, 'b': 2}, sorted=True)
+            Cache.put(key2, {'b': 3, 'c': 4}, sorted=True)
+            (res, n) = Cache.union(key1, key2, weights=[1, 2], aggregate="max")
+            self.assert_equal(n, 3)
+            self.assert_equal(self.r.zscore(res, "b"), 6.0)
+            self.assert_equal(self.r.zscore(res, "c"), 8.0)
+        finally:
+            Cache.disable_set_op_reuse()
+            Cache.remove("{setop}*", False)
+            Cache.remove(Cache.SET_OP_PREFIX + "*", False)
+            Cache.remove(Cache.SET_OP_DEPS_PREFIX + "*", False)
+
+    @test_case
+    def test25_write_buffer(self):
+        ''' Test buffering writes '''
+        
+        key = TEST_KEY + "_buffered"
+        buf = WriteBuffer(batch_size=100, flush_interval=60, max_pending=10)
+        try:
+            buf.put(key + "1", "a")
+            buf.put(key + "1", "b", ttl=60)
+            buf.put(key + "2", ["a"])
+            buf.put(key + "2", ["b", "c"])
+            self.assert_false(Cache.has(key + "1"))
+            buf.flush()
+            self.assert_equal(Cache.get(key + "1"), "b")
+            self.assert_gt(self.r.ttl(key + "1"), 0)
+            self.assert_equal(Cache.get(key + "2"), ["a", "b", "c"])
+            
+            # Strings and incompatible writes are applied in order
+            buf.put(key + "3", ["a"])
+            buf.put(key + "3", "b")
+            buf.put(key + "3", "c")
+            buf.put(key + "3", ["d"])
+            self.assert_false(Cache.has(key + "3"))
+            
+            # Full buffers get flushed right away
+            for i in range(25):
+                buf.put(key + "4", [i])
+            self.assert_true(buf.size() <= 10)
+        finally:
+            buf.close()
+        self.assert_equal(buf.size(), 0)
+        self.assert_equal(Cache.get(key + "3"), ["a", "b", "c", "d"])
+        self.assert_equal(Cache.get(key + "4"), range(25))
+        buf.put(key + "5", "a")
+        self.assert_equal(Cache.get(key + "5"), "a")
+        Cache.remove(key + "*", False)
+
+    @test_case
+    def test26_key_filter(self):
+        ''' Test answering lookups of absent keys from a Bloom filter '''
+        
+        prefix = Cache.NS_PREFIXES[Cache.NS_GEO_LOC]
+        key = prefix + "test"
+        def wait_for(condition):
+            deadline = time.time() + 5
+            while not condition() and time.time() < deadline:
+                time.sleep(0.01)
+            return condition()
+        
+        other = None
+        Cache.enable_key_filter([Cache.NS_GEO_LOC], capacity=1000, shared=False, sync_interval=0.05, 
+                                rebuild_interval=0.2)
+        try:
+            f = Cache._key_filter(key)
+            self.assert_true(wait_for(lambda: f.ready))
+            # Written behind Cache's back, the key is not seen until the next rebuild
+            self.r.set(key, TEST_STR)
+            self.assert_false(Cache.has(key))
+            self.assert_none(Cache.get(key))
+            self.assert_true(wait_for(lambda: Cache.has(key)))
+            Cache.put(key, TEST_STR)
+            self.assert_true(Cache.has(key))
+            self.assert_equal(Cache.get_many([key, key + "2"]), [TEST_STR, None])
+            Cache.remove(key, False)
+            self.assert_true(f.might_contain(key))
+            self.assert_true(wait_for(lambda: not f.might_contain(key)))
+            
+            # Shared with other processes
+            Cache.enable_key_filter([Cache.NS_GEO_LOC], capacity=1000, shared=True, sync_interval=0.05)
+            f = Cache._key_filter(key)
+            self.assert_true(wait_for(lambda: f.ready))
+            other = KeyFilter(self.r, prefix, 1000, shared=True, sync_interval=0.05)
+            self.assert_true(wait_for(lambda: other.ready))
+            self.assert_false(other.might_contain(key))
+            Cache.put(key, TEST_STR)
+            self.assert_true(wait_for(lambda: other.might_contain(key)))
+            other.close()
+            
+            # Keys being written are kept by a sync starting before their bits are set
+            r = HookedRedis(self.r)
+            other = KeyFilter(r, prefix, 1000, shared=True, sync_interval=60)
+            self.assert_true(wait_for(lambda: other.ready))
+            r.hook = other.sync
+            other.add([key + "_sync"])
+            self.r.set(key + "_sync", TEST_STR)
+            other.added([key + "_sync"])
+            self.assert_true(other.might_contain(key + "_sync"))
+            
+            # and by a rebuild scanning before they are written, shared ones included
+            other.add([key + "_rebuild"])
+            other.rebuild()
+            self.r.set(key + "_rebuild", TEST_STR)
+            other.added([key + "_rebuild"])
+            self.assert_true(other.might_contain(key + "_rebuild"))
+            other.close()
+            other = KeyFilter(self.r, prefix, 1000, shared=True, sync_interval=60)
+            self.assert_true(wait_for(lambda: other.ready))
+            self.assert_true(other.might_contain(key + "_rebuild"))
+        finally:
+            Cache.disable_key_filter()
+            if other:
+                other.close()
+            Cache.remove(prefix + "*", False)
+            Cache.remove(BLOOM_PREFIX + "*", False)
+
 if __name__ == "__main__":
+    if "--memory" in sys.argv:
+        # No server needed
+        Cache.init(client=MemoryRedis())
     TestCache().run()